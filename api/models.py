@@ -14,13 +14,14 @@ class Status(Enum):
     complete = "complete"
     error = "error"
     queued = "queued"
+    deferred = "deferred"
     running = "running"
     failed = "failed"
 
 
 class Result(BaseModel):
     created_at: datetime
-    enqueued_at: datetime
+    enqueued_at: datetime | None
     started_at: datetime | None
     job_result: dict | None
     job_error: str | None
@@ -36,6 +37,14 @@ class EquationType(Enum):
     LATEX = "latex"
     MATHML = "mathml"
 
+class EquationSet(BaseModel):
+    equations: List[str]
+    model: str = "petrinet"
+    model_id: Optional[str] = None
+    name: Optional[str] = None
+    description: Optional[str] = None
+
+
 class DomainType(Enum):
     EPI = "epi"
     CLIMATE = "climate"
\ No newline at end of file
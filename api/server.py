@@ -7,7 +7,7 @@ from typing import Annotated, List, Optional
 from fastapi import FastAPI, HTTPException, Path, Depends, status
 from fastapi.middleware.cors import CORSMiddleware
 
-from api.models import EquationType, ExtractionJob, DomainType
+from api.models import EquationSet, EquationType, ExtractionJob, DomainType
 from api.utils import create_job, fetch_job_status, get_redis
 from lib.settings import settings
 
@@ -99,6 +99,33 @@ def equations_to_amr(
     return resp
 
 
+@app.post("/equations_to_amr_batch")
+def equations_to_amr_batch(
+    payload: List[EquationSet],
+    equation_type: EquationType,
+    redis=Depends(get_redis),
+) -> ExtractionJob:
+    """Post many independent equation sets and store an AMR to TDS for each
+
+    Args:
+    ```
+        payload (List[EquationSet]): the equation sets, each with `equations` (a list of LaTeX or MathML strings)
+            and optionally `model` ("petrinet" or "regnet"), `model_id`, `name` and `description` as for `/equations_to_amr`
+        equation_type (str): [latex, mathml]
+    ```
+    """
+
+    operation_name = "operations.equations_to_amr_batch"
+    options = {
+        "equation_sets": [equation_set.model_dump() for equation_set in payload],
+        "equation_type": equation_type.value,
+    }
+
+    resp = create_job(operation_name=operation_name, options=options, redis=redis)
+
+    return resp
+
+
 @app.post("/code_to_amr")
 def code_to_amr(
     code_id: str,
@@ -166,6 +193,7 @@ async def variable_extractions(
     name: str = None,
     description: str = None,
     domain: DomainType = DomainType.EPI,
+    force_run: bool = False,
     redis=Depends(get_redis),
 ) -> ExtractionJob:
     """Run variable extractions over document
@@ -178,6 +206,7 @@ async def variable_extractions(
         * name: [str] name to give to the document (optional)
         * description: [str] description to apply to document (optional)
         * domain: [epi, climate] the knowledge graph domain to use (only used by MIT system)
+        * force_run: [bool] ignore cached SKEMA/MIT outputs for this text and annotate again
     ```
     """
     operation_name = "operations.variable_extractions"
@@ -190,6 +219,7 @@ async def variable_extractions(
         "name": name,
         "description": description,
         "domain": domain.value,
+        "force_run": force_run,
     }
 
     resp = create_job(operation_name=operation_name, options=options, redis=redis)
@@ -2,16 +2,84 @@
 Module used to interact with the Terarium Data Service (TDS).
 """
 
-from lib.settings import settings
+import os
+import threading
+
 import requests
+from requests.adapters import HTTPAdapter
+
+from lib.settings import settings
 
 TDS_URL = settings.TDS_URL
 TDS_USER = settings.TDS_USER
 TDS_PASSWORD = settings.TDS_PASSWORD
 
+# Sessions are shared by every call in a process but never across processes:
+# rq forks a work-horse per job, so a child re-initialises its own pools
+# instead of writing to sockets inherited from the parent.
+_sessions = {}
+_sessions_pid = None
+_sessions_lock = threading.Lock()
 
-def auth_session():
+
+def _pool_maxsize():
+	"""
+	Connections kept per host: at least `TDS_POOL_MAXSIZE`, and enough for the
+	widest fan-out of concurrent requests a job makes, so pooled connections
+	are not discarded and reopened under load.
+	"""
+	return max(
+		settings.TDS_POOL_MAXSIZE,
+		settings.CODE_DOWNLOAD_CONCURRENCY,
+		settings.DATASET_DOWNLOAD_CONCURRENCY,
+		settings.EQUATIONS_BATCH_CONCURRENCY,
+		settings.COSMOS_POLLER_CONCURRENCY,
+		# Every shard uploads its assets concurrently
+		settings.PDF_SHARD_CONCURRENCY * settings.COSMOS_ASSET_UPLOAD_CONCURRENCY,
+	)
+
+
+def _build_session():
 	session = requests.Session()
-	session.auth = (TDS_USER, TDS_PASSWORD)
-	session.headers.update({"Content-Type": "application/json", "X-Enable-Snake-Case": "true"})
+	adapter = HTTPAdapter(
+		pool_connections=settings.TDS_POOL_CONNECTIONS,
+		pool_maxsize=_pool_maxsize(),
+	)
+	session.mount("http://", adapter)
+	session.mount("https://", adapter)
+	if not settings.TDS_KEEPALIVE:
+		session.headers.update({"Connection": "close"})
 	return session
+
+
+def _get_session(kind):
+	global _sessions_pid
+
+	with _sessions_lock:
+		if _sessions_pid != os.getpid():
+			_sessions.clear()
+			_sessions_pid = os.getpid()
+
+		session = _sessions.get(kind)
+		if session is None:
+			session = _build_session()
+			if kind == "tds":
+				session.auth = (TDS_USER, TDS_PASSWORD)
+				session.headers.update({"Content-Type": "application/json", "X-Enable-Snake-Case": "true"})
+			_sessions[kind] = session
+		return session
+
+
+def auth_session():
+	"""
+	Process-wide, pooled session authenticated against TDS.
+	"""
+	return _get_session("tds")
+
+
+def http_session():
+	"""
+	Process-wide, pooled session without TDS credentials, used for presigned
+	storage URLs which must not carry an Authorization header.
+	"""
+	return _get_session("http")
@@ -25,16 +25,61 @@ class Settings(BaseSettings):
     MOCK_TDS: bool = True
     REDIS_HOST: str = "redis.knowledge-middleware"
     REDIS_PORT: int = 6379
+    WORKER_CONCURRENCY: str = "high=2,default=8,low=2"
     TA1_UNIFIED_URL: str = "https://api.askem.lum.ai"
     SKEMA_RS_URL: str = "http://skema-rs.staging.terarium.ai"
     MIT_TR_URL: str = "http://mit-tr.staging.terarium.ai"
+    SKEMA_ANNOTATION_TIMEOUT: float = 600
+    MIT_ANNOTATION_TIMEOUT: float = 600
+    ANNOTATION_CHUNK_CHARS: int = 0
+    ANNOTATION_CONCURRENCY: int = 4
+    VARIABLE_MERGE: str = "local"
+    ANNOTATION_VERSION: str = ""
+    # Batches across jobs only under `python -m worker.threaded`, see README
+    SKEMA_BATCH_WINDOW: float = 0
+    SKEMA_BATCH_MAX_SIZE: int = 8
     TDS_URL: str = "http://data-service.staging.terarium.ai:8000"
     TDS_USER: str = "user"
     TDS_PASSWORD: str = "password"
+    TDS_POOL_CONNECTIONS: int = 10
+    TDS_POOL_MAXSIZE: int = 10
+    TDS_KEEPALIVE: bool = True
+    TDS_MODEL_PATCH: bool = True
+    MODEL_WRITE_LOCK_TIMEOUT: float = 60
     COSMOS_URL: str = "http://xdd.wisc.edu/cosmos_service"
+    COSMOS_ASYNC_POLLING: bool = False
+    COSMOS_POLL_INTERVAL: float = 5
+    COSMOS_POLL_MAX_INTERVAL: float = 60
+    COSMOS_POLL_BACKOFF: float = 1.5
+    COSMOS_MAX_EXECUTION_TIME: int = 600
+    COSMOS_POLLER_CONCURRENCY: int = 32
+    COSMOS_ASSET_UPLOAD_CONCURRENCY: int = 8
+    COSMOS_RESULTS_FROM_ZIP: bool = True
+    COSMOS_SPOOL_MAX_SIZE: int = 64 * 1024 * 1024
     OPENAI_API_KEY: str = "foo"
     LOG_LEVEL: str = "INFO"
     PDF_EXTRACTOR: ExtractionServices = "cosmos"
+    PDF_SHARD_PAGES: int = 0
+    PDF_SHARD_CONCURRENCY: int = 4
+    EQUATIONS_BATCH_CONCURRENCY: int = 8
+    CODE_DOWNLOAD_CONCURRENCY: int = 16
+    CODE_MAX_FILE_BYTES: int = 10 * 1024 * 1024
+    CODE_RANGE_BYTES: int = 256 * 1024
+    CODE_ZIP_EXTENSIONS: str = ""
+    CODE_ZIP_EXCLUDE_EXTENSIONS: str = ".ipynb,.csv,.tsv,.parquet,.pkl,.npy,.npz,.h5,.hdf5,.nc,.mat,.png,.jpg,.jpeg,.gif,.pdf,.zip,.gz,.tar,.whl,.so,.dll,.exe,.bin"
+    CODE_ZIP_LANGUAGES: str = ""
+    CODE_ZIP_EXCLUDE_DIRS: str = ".git,node_modules,vendor,site-packages,__pycache__"
+    CODE_ZIP_MAX_FILE_BYTES: int = 1024 * 1024
+    CODE_ZIP_MAX_TOTAL_BYTES: int = 50 * 1024 * 1024
+    CODE_ZIP_COMPRESSION_LEVEL: int = 6
+    DATASET_DOWNLOAD_CONCURRENCY: int = 4
+    DATASET_SPOOL_MAX_SIZE: int = 64 * 1024 * 1024
+    DATA_PROFILE_CHUNK_ROWS: int = 100000
+    DATA_PROFILE_SAMPLE_ROWS: int = 10000
+    DATA_CARD_SAMPLE_ROWS: int = 200
+    CACHE_BACKEND: str = "none"
+    CACHE_DIR: str = "/tmp/knowledge-middleware-cache"
+    CACHE_MAX_BYTES: int = 1024 * 1024 * 1024
     AWS_ACCESS_KEY_ID: str = "NA"
     AWS_SECRET_ACCESS_KEY: str = "NA"
     BUCKET: str = "NA"
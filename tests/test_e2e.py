@@ -1,13 +1,37 @@
+import asyncio
+import copy
+import io
 import json
 import os
 import logging
+import threading
+from urllib.parse import parse_qs, urlparse
 
+import pandas
+import pyarrow.csv
+import pyarrow.feather
+import pyarrow.parquet
 import pytest
 import requests
 from rq.job import Job
 
 from lib.settings import settings, ExtractionServices
 from tests.utils import get_parameterizations, record_quality_check, AMR
+from worker import cosmos_poller
+from worker.annotation import chunk_text
+from worker.batching import SkemaBatcher
+from worker.cosmos_poller import CosmosPoller
+from worker.merge import merge_variable_attributes
+from worker.model_updates import update_model_in_tds
+from worker.profiling import profile_frames
+from worker.utils import (
+    amr_hash,
+    combine_dataset_files,
+    download_code_file,
+    fetch_code_lines,
+    line_offsets,
+    slice_lines,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -87,6 +111,219 @@ def test_variable_extractions(
         record_quality_check(context_dir, "profile_model", "Accuracy", accuracy)
 
 
+def test_skema_batcher(http_mock, redis):
+    #### ARRANGE ####
+    url = f"{settings.TA1_UNIFIED_URL}/text-reading/integrated-text-extractions"
+
+    def echo_texts(request, context):
+        return {
+            "outputs": [{"data": {"text": text}} for text in request.json()["texts"]],
+            "generalized_errors": [],
+        }
+
+    def submit_all(batcher, texts):
+        results = {}
+
+        def submit(text):
+            try:
+                results[text] = batcher.submit(text)[1]
+            except Exception as e:
+                results[text] = e
+
+        threads = [threading.Thread(target=submit, args=(text,)) for text in texts]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    texts = ["first", "second", "third"]
+
+    #### ACT ####
+    # A full batch is sent in one request and split back per text
+    echo = http_mock.post(url, json=echo_texts)
+    batcher = SkemaBatcher(url, window=5, max_size=3, timeout=5, connection=redis)
+    split = submit_all(batcher, texts)
+    echo_calls = echo.call_count
+
+    # Error bodies reach every caller as they are
+    http_mock.post(url, status_code=500, json={"detail": "SKEMA failed"})
+    errors = submit_all(batcher, texts)
+
+    # Callers waiting on a leader that never sends give up after the timeout
+    stalled = SkemaBatcher(url, window=0.1, max_size=3, timeout=0.1, connection=redis)
+    stalled.send = lambda batch: None
+    timeouts = submit_all(stalled, texts)
+
+    #### ASSERT ####
+    assert echo_calls == 1
+    assert {text: body["outputs"][0]["data"]["text"] for text, body in split.items()} == {
+        text: text for text in texts
+    }
+    assert all(body == {"detail": "SKEMA failed"} for body in errors.values())
+    assert sum(isinstance(result, TimeoutError) for result in timeouts.values()) == 2
+    assert redis.hget("skema-batcher:stats", "size:3") == b"2"
+
+
+@pytest.mark.skipif(not settings.MOCK_TA1, reason="Requires a mocked SKEMA")
+@pytest.mark.parametrize("resource", params["variable_extractions"])
+def test_variable_extractions_chunked(
+    context_dir,
+    http_mock,
+    client,
+    worker,
+    gen_tds_artifact,
+    monkeypatch,
+    resource,
+):
+    #### ARRANGE ####
+    monkeypatch.setattr(settings, "ANNOTATION_CHUNK_CHARS", 2000)
+    text_json = json.load(open(f"{context_dir}/text.json"))
+    text = ""
+    for d in text_json:
+        text += f"{d['content']}\n"
+    tds_artifact = gen_tds_artifact(
+        id=f"test_variable_extractions_chunked_{resource}",
+        file_names=["paper.pdf"],
+        text=text,
+    )
+    chunks = chunk_text(text, settings.ANNOTATION_CHUNK_CHARS)
+
+    extractions = json.load(open(f"{context_dir}/extractions.json"))
+    entity = next(
+        attribute
+        for attribute in extractions["outputs"][0]["data"]["attributes"]
+        if attribute["type"] == "anchored_entity"
+    )
+
+    # Report one entity per chunk at a position relative to the chunk's text
+    def annotate_chunk(request, context):
+        chunk = request.json()["texts"][0]
+        attribute = copy.deepcopy(entity)
+        source = attribute["payload"]["mentions"][0]["extraction_source"]
+        source["char_start"] = chunk.index(chunk.split()[0])
+        source["char_end"] = source["char_start"] + len(chunk.split()[0])
+        return {
+            "outputs": [{"data": {"attributes": [attribute]}}],
+            "generalized_errors": [],
+        }
+
+    http_mock.post(
+        f"{settings.TA1_UNIFIED_URL}/text-reading/integrated-text-extractions?annotate_skema=True&annotate_mit=False",
+        json=annotate_chunk,
+    )
+
+    query_params = {
+        "document_id": tds_artifact["id"],
+        "annotate_skema": True,
+        "annotate_mit": False,
+    }
+
+    #### ACT ####
+    response = client.post(
+        "/variable_extractions",
+        params=query_params,
+        headers={"Content-Type": "application/json"},
+    )
+    job_id = response.json().get("id")
+    worker.work(burst=True)
+    status_response = client.get(f"/status/{job_id}")
+    job = Job.fetch(job_id, connection=worker.connection)
+
+    #### ASSERT ####
+    assert len(chunks) > 1
+    assert (
+        status_response.json().get("status") == "finished"
+    ), f"The RQ job failed.\n{job.latest_result().exc_string}"
+    sources = [
+        attribute["payload"]["mentions"][0]["extraction_source"]
+        for attribute in status_response.json()["result"]["job_result"]["extraction"][
+            "attributes"
+        ]
+    ]
+    assert len(sources) == len(chunks)
+    for source, (offset, chunk) in zip(sources, chunks):
+        word = chunk.split()[0]
+        assert source["char_start"] == offset + chunk.index(word)
+        assert text[source["char_start"] : source["char_end"]] == word
+
+
+def test_merge_variable_attributes():
+    #### ARRANGE ####
+    def entity(id, name, span=None, grounding=None):
+        source = {"document_reference": {"id": "paper"}}
+        if span is not None:
+            source.update(char_start=span[0], char_end=span[1])
+        groundings = []
+        if grounding is not None:
+            groundings.append({"grounding_id": grounding[0], "score": grounding[1]})
+        return {
+            "type": "anchored_entity",
+            "payload": {
+                "id": {"id": id},
+                "mentions": [
+                    {"id": f"{id}-mention", "name": name, "extraction_source": source}
+                ],
+                "text_descriptions": [],
+                "value_descriptions": [],
+                "groundings": groundings,
+            },
+        }
+
+    def context(id, *entity_ids):
+        return {
+            "type": "scenario_context",
+            "payload": {"id": {"id": id}, "extractions": [{"id": i} for i in entity_ids]},
+        }
+
+    skema = {
+        "attributes": [
+            entity("s-beta", "Beta", span=(10, 14)),
+            entity("s-gamma", "gamma", grounding=("apollosv:00000154", 0.95)),
+            entity("s-s", "S", span=(40, 41)),
+            entity("s-n", "N", grounding=("ncit:C25463", 0.5)),
+            context("s-context", "s-beta", "s-gamma", "s-s", "s-n"),
+        ]
+    }
+    mit = {
+        "attributes": [
+            # Same primary name once normalised
+            entity("m-beta", "beta_", span=(100, 104)),
+            # Same confident grounding under another name
+            entity("m-gamma", "recovery rate", grounding=("apollosv:00000154", 0.92)),
+            # Same span under another name
+            entity("m-s", "Susceptible", span=(40, 41)),
+            # Groundings below the threshold do not identify an entity
+            entity("m-n", "population", grounding=("ncit:C25463", 0.5)),
+            context("m-context", "m-beta", "s-beta", "m-n"),
+        ]
+    }
+
+    #### ACT ####
+    merged = merge_variable_attributes(skema, mit)
+
+    #### ASSERT ####
+    entities = {
+        a["payload"]["id"]["id"]: a["payload"]
+        for a in merged
+        if a["type"] == "anchored_entity"
+    }
+    contexts = {
+        a["payload"]["id"]["id"]: [e["id"] for e in a["payload"]["extractions"]]
+        for a in merged
+        if a["type"] == "scenario_context"
+    }
+    assert sorted(entities) == ["m-n", "s-beta", "s-gamma", "s-n", "s-s"]
+    assert [m["name"] for m in entities["s-beta"]["mentions"]] == ["Beta", "beta_"]
+    assert [m["name"] for m in entities["s-gamma"]["mentions"]] == ["gamma", "recovery rate"]
+    assert [m["name"] for m in entities["s-s"]["mentions"]] == ["S", "Susceptible"]
+    assert len(entities["s-gamma"]["groundings"]) == 2
+    assert contexts == {
+        "s-context": ["s-beta", "s-gamma", "s-s", "s-n"],
+        "m-context": ["s-beta", "m-n"],
+    }
+
+
 @pytest.mark.parametrize("resource", params["pdf_extraction"])
 def test_pdf_to_cosmos(
     context_dir, http_mock, client, worker, gen_tds_artifact, file_storage, resource
@@ -175,6 +412,286 @@ def test_pdf_to_cosmos(
     ), f"The RQ job failed.\n{job.latest_result().exc_string}"
 
 
+@pytest.mark.skipif(
+    not settings.MOCK_TA1 or settings.PDF_EXTRACTOR != ExtractionServices.COSMOS,
+    reason="Requires a mocked Cosmos",
+)
+@pytest.mark.parametrize("resource", params["pdf_extraction"])
+def test_pdf_to_cosmos_async_polling(
+    context_dir,
+    http_mock,
+    client,
+    worker,
+    redis,
+    gen_tds_artifact,
+    file_storage,
+    monkeypatch,
+    resource,
+):
+    #### ARRANGE ####
+    monkeypatch.setattr(settings, "COSMOS_ASYNC_POLLING", True)
+    tds_artifact = gen_tds_artifact(
+        id=f"test_pdf_to_cosmos_async_{resource}", file_names=["paper.pdf"]
+    )
+    pdf_file = open(f"{context_dir}/paper.pdf", "rb")
+    file_storage.upload("paper.pdf", pdf_file)
+
+    job_id = "test-async-job"
+    result_endpoint = f"{settings.COSMOS_URL}/process/{job_id}/result"
+    http_mock.post(
+        f"{settings.COSMOS_URL}/process/",
+        json={
+            "job_id": job_id,
+            "status_endpoint": f"{settings.COSMOS_URL}/process/{job_id}/status",
+            "result_endpoint": result_endpoint,
+        },
+    )
+    # Cosmos is still running on the first poll and done on the second
+    status_mock = http_mock.get(
+        f"{settings.COSMOS_URL}/process/{job_id}/status",
+        [
+            {"json": {"job_started": True, "job_completed": False, "error": None}},
+            {"json": {"job_started": True, "job_completed": True, "error": None}},
+        ],
+    )
+    with open(f"{context_dir}/paper_cosmos_output.zip", "rb") as f:
+        http_mock.get(result_endpoint, content=f.read())
+    http_mock.get(
+        f"{result_endpoint}/text",
+        json=json.load(open(f"{context_dir}/cosmos_result.json")),
+    )
+    for asset_type in ["equations", "figures", "tables"]:
+        http_mock.get(
+            f"{result_endpoint}/extractions/{asset_type}",
+            json=json.load(open(f"{context_dir}/cosmos_{asset_type}.json")),
+        )
+
+    #### ACT ####
+    response = client.post(
+        "/pdf_extraction",
+        params={"document_id": tds_artifact["id"]},
+        headers={"Content-Type": "application/json"},
+    )
+    worker.work(burst=True)
+    status_response = client.get(f"/status/{response.json().get('id')}")
+    submit_result = status_response.json()["result"]["job_result"]
+    polls_before_handoff = status_mock.call_count
+
+    continuation_id = submit_result["continuation_job_id"]
+    deferred_response = client.get(f"/status/{continuation_id}")
+
+    poller = CosmosPoller(connection=redis)
+    asyncio.run(poller.poll_due())
+    still_pending = continuation_id in poller.schedule
+    poller.schedule[continuation_id] = (0, settings.COSMOS_POLL_INTERVAL)
+    asyncio.run(poller.poll_due())
+
+    worker.work(burst=True)
+    continuation_response = client.get(f"/status/{continuation_id}")
+
+    #### ASSERT ####
+    # The submitting job finished without waiting on Cosmos
+    assert status_response.json().get("status") == "finished"
+    assert polls_before_handoff == 0
+    # The continuation can be followed before Cosmos is done
+    assert deferred_response.json().get("status") == "deferred"
+    assert still_pending
+    assert status_mock.call_count == 2
+    assert continuation_response.json().get("status") == "finished"
+    assert (
+        continuation_response.json()["result"]["job_result"]["cosmos_job_id"] == job_id
+    )
+
+
+@pytest.mark.skipif(
+    not settings.MOCK_TA1 or settings.PDF_EXTRACTOR != ExtractionServices.COSMOS,
+    reason="Requires a mocked Cosmos",
+)
+@pytest.mark.parametrize("resource", params["pdf_extraction"])
+def test_pdf_to_cosmos_sharded(
+    context_dir,
+    http_mock,
+    client,
+    worker,
+    gen_tds_artifact,
+    file_storage,
+    monkeypatch,
+    resource,
+):
+    #### ARRANGE ####
+    # The 8 page paper is extracted as two shards of 4 pages
+    monkeypatch.setattr(settings, "PDF_SHARD_PAGES", 4)
+    monkeypatch.setattr(settings, "COSMOS_RESULTS_FROM_ZIP", False)
+    tds_artifact = gen_tds_artifact(
+        id=f"test_pdf_to_cosmos_sharded_{resource}", file_names=["paper.pdf"]
+    )
+    file_storage.upload("paper.pdf", open(f"{context_dir}/paper.pdf", "rb"))
+    document_update = http_mock.put(
+        f"{settings.TDS_URL}/document-asset/{tds_artifact['id']}",
+        json={"id": tds_artifact["id"]},
+    )
+
+    job_id = "test-sharded-job"
+    result_endpoint = f"{settings.COSMOS_URL}/process/{job_id}/result"
+    http_mock.post(
+        f"{settings.COSMOS_URL}/process/",
+        json={
+            "job_id": job_id,
+            "status_endpoint": f"{settings.COSMOS_URL}/process/{job_id}/status",
+            "result_endpoint": result_endpoint,
+        },
+    )
+    http_mock.get(
+        f"{settings.COSMOS_URL}/process/{job_id}/status",
+        json={"job_started": True, "job_completed": True, "error": None},
+    )
+    with open(f"{context_dir}/paper_cosmos_output.zip", "rb") as f:
+        http_mock.get(result_endpoint, content=f.read())
+    # Cosmos names every record after the shard it was given
+    text_records = json.load(open(f"{context_dir}/cosmos_result.json"))
+    for record in text_records:
+        record["pdf_name"] = "paper_shard_0.pdf"
+    http_mock.get(f"{result_endpoint}/text", json=text_records)
+    for asset_type in ["equations", "figures", "tables"]:
+        http_mock.get(
+            f"{result_endpoint}/extractions/{asset_type}",
+            json=json.load(open(f"{context_dir}/cosmos_{asset_type}.json")),
+        )
+
+    #### ACT ####
+    response = client.post(
+        "/pdf_extraction",
+        params={"document_id": tds_artifact["id"]},
+        headers={"Content-Type": "application/json"},
+    )
+    worker.work(burst=True)
+    status_response = client.get(f"/status/{response.json().get('id')}")
+    extraction = status_response.json()["result"]["job_result"]["extraction"]
+
+    #### ASSERT ####
+    assert status_response.json().get("status") == "finished"
+    assert len(extraction) == 2 * len(text_records)
+    # Pages of the second shard are shifted by the first shard's 4 pages
+    assert [int(r["page_num"]) for r in extraction] == [
+        int(r["page_num"]) + offset for offset in (0, 4) for r in text_records
+    ]
+    assert {r["pdf_name"] for r in extraction} == {"paper.pdf"}
+    assert document_update.last_request.json()["file_names"] == [
+        "paper.pdf",
+        f"{tds_artifact['id']}_cosmos_0.zip",
+        f"{tds_artifact['id']}_cosmos_1.zip",
+    ]
+
+
+@pytest.mark.skipif(
+    not settings.MOCK_TA1 or settings.PDF_EXTRACTOR != ExtractionServices.COSMOS,
+    reason="Requires a mocked Cosmos",
+)
+@pytest.mark.parametrize("resource", params["pdf_extraction"])
+def test_pdf_to_cosmos_cached(
+    context_dir,
+    http_mock,
+    client,
+    worker,
+    gen_tds_artifact,
+    file_storage,
+    monkeypatch,
+    tmp_path,
+    resource,
+):
+    #### ARRANGE ####
+    monkeypatch.setattr(settings, "CACHE_BACKEND", "disk")
+    monkeypatch.setattr(settings, "CACHE_DIR", str(tmp_path))
+    # Two documents holding the same PDF, and one that was already extracted
+    first, second = (
+        gen_tds_artifact(
+            id=f"test_pdf_to_cosmos_cached_{i}_{resource}", file_names=["paper.pdf"]
+        )
+        for i in range(2)
+    )
+    extracted = gen_tds_artifact(
+        id=f"test_pdf_to_cosmos_extracted_{resource}",
+        file_names=["paper.pdf"],
+        text="Extracted text",
+        assets=[{"file_name": "figure.png", "asset_type": "figure", "metadata": {}}],
+    )
+    file_storage.upload("paper.pdf", open(f"{context_dir}/paper.pdf", "rb"))
+    second_update = http_mock.put(
+        f"{settings.TDS_URL}/document-asset/{second['id']}",
+        json={"id": second["id"]},
+    )
+
+    job_id = "test-cached-job"
+    result_endpoint = f"{settings.COSMOS_URL}/process/{job_id}/result"
+    cosmos_submit = http_mock.post(
+        f"{settings.COSMOS_URL}/process/",
+        json={
+            "job_id": job_id,
+            "status_endpoint": f"{settings.COSMOS_URL}/process/{job_id}/status",
+            "result_endpoint": result_endpoint,
+        },
+    )
+    http_mock.get(
+        f"{settings.COSMOS_URL}/process/{job_id}/status",
+        json={"job_started": True, "job_completed": True, "error": None},
+    )
+    with open(f"{context_dir}/paper_cosmos_output.zip", "rb") as f:
+        zip_content = f.read()
+    http_mock.get(result_endpoint, content=zip_content)
+    http_mock.get(
+        f"{result_endpoint}/text",
+        json=json.load(open(f"{context_dir}/cosmos_result.json")),
+    )
+    for asset_type in ["equations", "figures", "tables"]:
+        http_mock.get(
+            f"{result_endpoint}/extractions/{asset_type}",
+            json=json.load(open(f"{context_dir}/cosmos_{asset_type}.json")),
+        )
+
+    #### ACT ####
+    results = []
+    for document in [first, second, extracted]:
+        response = client.post(
+            "/pdf_extraction",
+            params={"document_id": document["id"]},
+            headers={"Content-Type": "application/json"},
+        )
+        worker.work(burst=True)
+        status_response = client.get(f"/status/{response.json().get('id')}")
+        results.append(status_response.json()["result"]["job_result"])
+
+    #### ASSERT ####
+    assert [result["cache"] for result in results] == ["miss", "hit", "document"]
+    # Cosmos ran once, the second document got a renamed copy of the zipfile
+    assert cosmos_submit.call_count == 1
+    assert results[1]["extraction"] == results[0]["extraction"]
+    second_zip = f"{second['id']}_cosmos.zip"
+    assert second_update.last_request.json()["file_names"] == ["paper.pdf", second_zip]
+    assert file_storage.retrieve(second_zip) == zip_content
+    assets = second_update.last_request.json()["assets"]
+    assert assets and all(file_storage.retrieve(asset["file_name"]) for asset in assets)
+
+
+def test_cosmos_poller_times_out_on_bad_status(http_mock, redis, monkeypatch):
+    #### ARRANGE ####
+    monkeypatch.setattr(settings, "COSMOS_MAX_EXECUTION_TIME", 0)
+    status_endpoint = f"{settings.COSMOS_URL}/process/missing-job/status"
+    http_mock.get(status_endpoint, status_code=404, json={"detail": "Not Found"})
+    continuation_id = cosmos_poller.register(
+        status_endpoint, {"document_id": "test"}, connection=redis
+    )
+
+    #### ACT ####
+    poller = CosmosPoller(connection=redis)
+    asyncio.run(poller.poll_due())
+
+    #### ASSERT ####
+    job = Job.fetch(continuation_id, connection=redis)
+    assert job.get_status() == "queued"
+    assert "Job not complete" in job.kwargs["cosmos_error"]
+    assert not redis.hexists(cosmos_poller.PENDING_KEY, continuation_id)
+
+
 @pytest.mark.parametrize("resource", params["code_to_amr"])
 def test_code_dynamics_to_amr(
     context_dir, http_mock, client, worker, gen_tds_artifact, file_storage, resource
@@ -322,6 +839,137 @@ def test_code_zip_to_amr(
     #     record_quality_check(context_dir, "code_to_amr", "F1 Score", amr_instance.f1(amr))
 
 
+def test_fetch_code_lines(http_mock, monkeypatch):
+    #### ARRANGE ####
+    monkeypatch.setattr(settings, "CODE_RANGE_BYTES", 8)
+    content = b"".join(f"line {i}\n".encode() for i in range(1, 9))  # 7 bytes a line
+    ranged_url = "mock://code/ranged.py"
+    whole_url = "mock://code/whole.py"
+    exact_url = "mock://code/exact.py"
+    exact = content[:16]
+
+    def serve_range(body):
+        def callback(request, context):
+            start, end = map(int, request.headers["Range"][len("bytes=") :].split("-"))
+            if start >= len(body):
+                context.status_code = 416
+                return b""
+            context.status_code = 206
+            return body[start : end + 1]
+
+        return callback
+
+    ranged = http_mock.get(ranged_url, content=serve_range(content))
+    http_mock.get(exact_url, content=serve_range(exact))
+    # A store ignoring the Range header sends the whole file
+    http_mock.get(whole_url, content=content)
+    http_mock.get(
+        "mock://code/denied.py", status_code=403, content=b"<Error>AccessDenied</Error>"
+    )
+    http_mock.get(
+        f"{settings.TDS_URL}/code-asset/denied/download-url",
+        json={"url": "mock://code/denied.py"},
+    )
+
+    #### ACT ####
+    ranged_lines = fetch_code_lines(ranged_url, 3)
+    whole_lines = fetch_code_lines(whole_url, 3)
+    # The file ends on a range boundary, so the last request is past its end
+    exact_lines = fetch_code_lines(exact_url, 5)
+    offsets = line_offsets(content)
+
+    #### ASSERT ####
+    # Whole ranges are fetched until they hold the 3 lines
+    assert ranged_lines == content[:24]
+    assert ranged.call_count == 3
+    assert whole_lines == content
+    assert exact_lines == exact
+    assert slice_lines(content, offsets, 2, 3) == b"line 2\nline 3"
+    assert slice_lines(content, offsets, 7, 20) == b"line 7\nline 8"
+    assert slice_lines(content, offsets, 12, 20) == b""
+    with pytest.raises(requests.HTTPError):
+        fetch_code_lines("mock://code/denied.py", 3)
+    with pytest.raises(requests.HTTPError):
+        download_code_file("denied", "denied.py")
+
+
+@pytest.mark.skipif(not settings.MOCK_TA1, reason="Requires a mocked SKEMA")
+@pytest.mark.parametrize("resource", params["code_to_amr"])
+def test_code_zip_manifest(
+    context_dir,
+    http_mock,
+    client,
+    worker,
+    gen_tds_artifact,
+    file_storage,
+    monkeypatch,
+    resource,
+):
+    #### ARRANGE ####
+    monkeypatch.setattr(settings, "CODE_ZIP_LANGUAGES", "python")
+    monkeypatch.setattr(settings, "CODE_ZIP_MAX_FILE_BYTES", 1024)
+    code = open(f"{context_dir}/code/code.py").read()
+    files = {
+        "code.py": code,
+        "model/big.py": "x = 1\n" * 1024,
+        "model/binary.py": b"\xff\xfe\x00",
+        "node_modules/lib/index.js": "module.exports = {}",
+        "data/data.csv": "x,y\n1,2\n",
+        "model.R": "x <- 1",
+    }
+    tds_code = gen_tds_artifact(
+        code=True,
+        id=f"test_code_zip_manifest_{resource}",
+        files={
+            name: {"language": "r" if name.endswith(".R") else "python"}
+            for name in files
+        },
+    )
+    for name, content in files.items():
+        if isinstance(content, bytes):
+            content = io.BytesIO(content)
+        file_storage.upload(name, content)
+
+    http_mock.post(f"{settings.TDS_URL}/provenance", json={})
+    http_mock.post(f"{settings.TDS_URL}/models", json={"id": "test"})
+    http_mock.post(f"{settings.TDS_URL}/model-configurations", json={"id": "test"})
+    amr = json.load(open(f"{context_dir}/amr.json"))
+    http_mock.post(
+        f"{settings.TA1_UNIFIED_URL}/workflows/code/llm-assisted-codebase-to-pn-amr",
+        json=amr,
+    )
+
+    #### ACT ####
+    response = client.post(
+        "/code_to_amr",
+        params={"code_id": tds_code["id"], "dynamics_only": False},
+        headers={"Content-Type": "application/json"},
+    )
+    job_id = response.json().get("id")
+    worker.work(burst=True)
+    job = Job.fetch(job_id, connection=worker.connection)
+    downloaded = [
+        parse_qs(urlparse(request.url).query)["filename"][0]
+        for request in http_mock.request_history
+        if "download-url" in request.url
+    ]
+
+    #### ASSERT ####
+    assert job.result is not None, f"The RQ job failed.\n{job.latest_result().exc_string}"
+    manifest = job.result["zip_manifest"]
+    assert manifest["included"] == ["code.py"]
+    assert manifest["bytes"] == len(code.encode())
+    assert {s["name"]: s["reason"] for s in manifest["skipped"]} == {
+        "node_modules/lib/index.js": "excluded directory",
+        "data/data.csv": "excluded extension",
+        "model.R": "excluded language",
+        "model/big.py": "file too large",
+        "model/binary.py": "not utf-8 text",
+    }
+    # Filtered files are never downloaded
+    assert sorted(downloaded) == ["code.py", "model/big.py", "model/binary.py"]
+
+
 @pytest.mark.parametrize("resource", params["equations_to_amr"])
 def test_equations_to_amr(context_dir, http_mock, client, worker, file_storage):
     #### ARRANGE ####
@@ -441,11 +1089,164 @@ def test_equations_to_amr(context_dir, http_mock, client, worker, file_storage):
     #     record_quality_check(context_dir, "equations_to_amr", "F1 Score", amr_instance.f1(amr))
 
 
+@pytest.mark.parametrize("resource", params["equations_to_amr"])
+def test_equations_to_amr_batch(context_dir, http_mock, client, worker, file_storage):
+    #### ARRANGE ####
+    equations = json.load(open(f"{context_dir}/equations.txt"))
+
+    # The second set only differs in whitespace, so it is converted once
+    payload = [
+        {"equations": equations, "name": "test model"},
+        {"equations": [f"  {equation} " for equation in equations], "name": "test model 2"},
+    ]
+
+    if settings.MOCK_TDS:
+        http_mock.post(f"{settings.TDS_URL}/models", json={"id": "test"})
+        http_mock.post(
+            f"{settings.TDS_URL}/model-configurations",
+            json={"id": "configuration_test_id"},
+        )
+    if settings.MOCK_TA1:
+        amr = json.load(open(f"{context_dir}/amr.json"))
+        conversion = http_mock.post(
+            f"{settings.TA1_UNIFIED_URL}/workflows/latex/equations-to-amr", json=amr
+        )
+
+    #### ACT ####
+    response = client.post(
+        "/equations_to_amr_batch",
+        params={"equation_type": "latex"},
+        json=payload,
+    )
+    results = response.json()
+    job_id = results.get("id")
+    worker.work(burst=True)
+    status_response = client.get(f"/status/{job_id}")
+
+    job = Job.fetch(job_id, connection=worker.connection)
+
+    #### ASSERT ####
+    assert results.get("status") == "queued"
+    assert (
+        status_response.json().get("status") == "finished"
+    ), f"The RQ job failed.\n{job.latest_result().exc_string}"
+
+    assert job.result["succeeded"] == len(payload)
+    assert [r["tds_model_id"] for r in job.result["results"]] == ["test", "test"]
+    if settings.MOCK_TA1:
+        assert conversion.call_count == 1
+
+
+@pytest.mark.parametrize("edited", [False, True])
+@pytest.mark.parametrize("resource", params["equations_to_amr"])
+def test_equations_to_amr_unchanged(
+    context_dir, http_mock, client, worker, file_storage, edited
+):
+    #### ARRANGE ####
+    equations = open(f"{context_dir}/equations.txt").read()
+    amr = json.load(open(f"{context_dir}/amr.json"))
+
+    # TDS already holds the AMR the conversion returns, with its own fields
+    stored_amr = json.loads(json.dumps(amr))
+    stored_amr["id"] = "test2"
+    stored_amr["timestamp"] = "2023-07-17T19:11:43"
+    stored_amr["metadata"] = dict(
+        stored_amr.get("metadata") or {}, amr_hash=amr_hash(stored_amr)
+    )
+    if edited:
+        # Changed by another client, leaving the stored hash stale
+        stored_amr["model"]["states"] = stored_amr["model"]["states"][:1]
+
+    http_mock.get(f"{settings.TDS_URL}/models/test2", json=stored_amr)
+    model_update = http_mock.put(f"{settings.TDS_URL}/models/test2", json={"id": "test2"})
+    configuration = http_mock.post(
+        f"{settings.TDS_URL}/model-configurations", json={"id": "configuration_test_id"}
+    )
+    http_mock.post(
+        f"{settings.TA1_UNIFIED_URL}/workflows/latex/equations-to-amr", json=amr
+    )
+
+    #### ACT ####
+    response = client.post(
+        "/equations_to_amr",
+        params={"equation_type": "latex", "model": "petrinet", "model_id": "test2"},
+        data=equations,
+        headers={"Content-Type": "application/json"},
+    )
+    job_id = response.json().get("id")
+    worker.work(burst=True)
+    job = Job.fetch(job_id, connection=worker.connection)
+
+    #### ASSERT ####
+    assert job.result is not None, f"The RQ job failed.\n{job.latest_result().exc_string}"
+    assert job.result["tds_model_unchanged"] is not edited
+    assert model_update.call_count == configuration.call_count == int(edited)
+
+
+def test_profile_frames():
+    #### ARRANGE ####
+    # The same column read as integers in one chunk and floats in the next
+    chunks = [
+        pandas.DataFrame({"x": [1, 2, 2]}),
+        pandas.DataFrame({"x": [2.0, 3.5, None]}),
+    ]
+
+    #### ACT ####
+    profile = profile_frames(iter(chunks))
+
+    #### ASSERT ####
+    stats = profile.columns["x"]
+    assert stats["type"] == "float"
+    assert (stats["min"], stats["max"]) == (1.0, 3.5)
+    assert isinstance(stats["min"], float)
+    assert stats["most_common_entries"] == {"2": 3, "1": 1, "3.5": 1}
+    assert (stats["num_entries"], stats["num_null_entries"]) == (6, 1)
+
+
+def test_combine_dataset_files():
+    #### ARRANGE ####
+    dataset_files = [
+        # Same header as the combined one, copied as is
+        ("csv", io.BytesIO(b"x,y,z\n1,2,3\n")),
+        # Byte order mark and no trailing newline
+        ("csv", io.BytesIO(b"\xef\xbb\xbfx,y,z\n4,5,6")),
+        # Columns in another order, and one missing
+        ("csv", io.BytesIO(b"z,x\n7,8\n")),
+    ]
+    disjoint_files = [
+        ("csv", io.BytesIO(b"x\n1\n")),
+        ("csv", io.BytesIO(b"\xef\xbb\xbfy\n2\n")),
+    ]
+
+    #### ACT ####
+    combined = combine_dataset_files(dataset_files)
+    disjoint = combine_dataset_files(disjoint_files)
+
+    #### ASSERT ####
+    assert combined.read().decode() == "x,y,z\n1,2,3\n4,5,6\n8,,7\n"
+    assert disjoint.read().decode() == "x,y\n1,\n,2\n"
+    # The downloaded files are left to the caller to close
+    assert not any(f.closed for _, f in dataset_files + disjoint_files)
+
+
+@pytest.mark.parametrize("dataset_format", ["csv", "parquet", "arrow"])
+@pytest.mark.parametrize("sample_rows", [200, 0])
 @pytest.mark.parametrize("resource", params["profile_dataset"])
 def test_profile_dataset(
-    context_dir, http_mock, client, worker, gen_tds_artifact, file_storage, resource
+    context_dir,
+    http_mock,
+    client,
+    worker,
+    gen_tds_artifact,
+    file_storage,
+    resource,
+    sample_rows,
+    dataset_format,
+    monkeypatch,
 ):
     #### ARRANGE ####
+    # With no sample size the whole dataset is sent to MIT
+    monkeypatch.setattr(settings, "DATA_CARD_SAMPLE_ROWS", sample_rows)
     CHAR_LIMIT = 250
     text_json = json.load(open(f"{context_dir}/text.json"))
     text = ""
@@ -462,23 +1263,37 @@ def test_profile_dataset(
     pdf = open(f"{context_dir}/paper.pdf", "rb")
     file_storage.upload("paper.pdf", pdf)
     csvfile = open(f"{context_dir}/data.csv").read()
-    file_storage.upload("data.csv", csvfile)
+    dataset_file = f"data.{dataset_format}"
+    if dataset_format == "csv":
+        file_storage.upload(dataset_file, csvfile)
+    else:
+        # Parquet and Arrow files are read memory-mapped
+        table = pyarrow.csv.read_csv(f"{context_dir}/data.csv")
+        columnar = io.BytesIO()
+        if dataset_format == "parquet":
+            pyarrow.parquet.write_table(table, columnar)
+        else:
+            pyarrow.feather.write_feather(table, columnar)
+        columnar.seek(0)
+        file_storage.upload(dataset_file, columnar)
 
     dataset = {
         "id": tds_artifact["id"],
         "name": "data",
         "description": "test data",
         "timestamp": "2023-07-17T19:11:43",
-        "file_names": ["data.csv"],
+        "file_names": [dataset_file],
         "metadata": {},
     }
     http_mock.get(f"{settings.TDS_URL}/datasets/{dataset['id']}", json=dataset)
-    http_mock.put(
+    dataset_update = http_mock.put(
         f"{settings.TDS_URL}/datasets/{dataset['id']}", json={"id": dataset["id"]}
     )
     if settings.MOCK_TA1:
         data_card = json.load(open(f"{context_dir}/data_card.json"))
-        http_mock.post(f"{settings.MIT_TR_URL}/cards/get_data_card", json=data_card)
+        data_card_request = http_mock.post(
+            f"{settings.MIT_TR_URL}/cards/get_data_card", json=data_card
+        )
 
     #### ACT ####
     response = client.post(
@@ -498,6 +1313,73 @@ def test_profile_dataset(
         status_response.json().get("status") == "finished"
     ), f"The RQ job failed.\n{job.latest_result().exc_string}"
     logger.debug(status_response.json())
+    columns = {c["name"]: c for c in dataset_update.last_request.json()["columns"]}
+    assert list(columns) == csvfile.splitlines()[0].split(",")
+    assert columns["I"]["metadata"]["column_stats"]["max"] == max(
+        int(line.split(",")[1]) for line in csvfile.splitlines()[1:]
+    )
+    if settings.MOCK_TA1 and sample_rows == 0 and dataset_format == "csv":
+        body = data_card_request.last_request.body
+        assert all(line.encode() in body for line in csvfile.splitlines())
+
+
+def test_update_model_in_tds(http_mock, redis, monkeypatch):
+    #### ARRANGE ####
+    model_id = "test_update_model"
+    model_url = f"{settings.TDS_URL}/models/{model_id}"
+    model = {"id": model_id, "metadata": {"amr_hash": "stale"}, "model": {"states": []}}
+    stored = {"id": model_id, "metadata": {}, "model": {"states": []}, "tds_field": 1}
+    http_mock.get(model_url, json=stored)
+    put = http_mock.put(model_url, json={"id": model_id})
+    pending = f"model-writes:{model_id}:pending"
+
+    #### ACT ####
+    # A patch answered with 204 is a successful write
+    http_mock.patch(model_url, status_code=204)
+    accepted = update_model_in_tds(
+        model_id, model, dict(model, name="SIR"), connection=redis
+    )
+
+    # A patch queued by another job is sent along in the same request
+    patch = http_mock.patch(model_url, json={"id": model_id})
+    redis.rpush(
+        pending,
+        json.dumps(
+            {
+                "id": "other",
+                "operations": [{"op": "add", "path": "/description", "value": "d"}],
+            }
+        ),
+    )
+    coalesced = update_model_in_tds(
+        model_id, model, dict(model, name="SIR"), connection=redis
+    )
+    coalesced_operations = patch.last_request.json()
+
+    # TDS refusing the patch falls back on a PUT of the patched model
+    http_mock.patch(model_url, status_code=405)
+    fallback = update_model_in_tds(
+        model_id, model, dict(model, name="SIR"), connection=redis
+    )
+
+    # A job that times out withdraws its patch
+    monkeypatch.setattr(settings, "MODEL_WRITE_LOCK_TIMEOUT", 0.1)
+    redis.set(f"model-writes:{model_id}:lock", "another job")
+    with pytest.raises(Exception, match="Timed out"):
+        update_model_in_tds(model_id, model, dict(model, name="SEIR"), connection=redis)
+
+    #### ASSERT ####
+    assert accepted == coalesced == fallback == 200
+    assert patch.call_count == 1
+    assert coalesced_operations == [
+        {"op": "add", "path": "/description", "value": "d"},
+        {"op": "remove", "path": "/metadata/amr_hash"},
+        {"op": "add", "path": "/name", "value": "SIR"},
+    ]
+    assert redis.hget(f"model-writes:{model_id}:results", "other") == b"200"
+    assert put.call_count == 1
+    assert put.last_request.json() == dict(stored, name="SIR")
+    assert redis.llen(pending) == 0
 
 
 @pytest.mark.parametrize("resource", params["profile_model"])
@@ -534,7 +1416,12 @@ def test_profile_model(
         http_mock.get(
             f"{settings.TDS_URL}/models/{model_id}", json={"id": model_id, "model": amr}
         )
-        http_mock.put(f"{settings.TDS_URL}/models/{model_id}", json={"id": model_id})
+        model_update = http_mock.put(
+            f"{settings.TDS_URL}/models/{model_id}", json={"id": model_id}
+        )
+        model_patch = http_mock.patch(
+            f"{settings.TDS_URL}/models/{model_id}", json={"id": model_id}
+        )
     else:
         amr["id"] = model_id
         requests.post(f"{settings.TDS_URL}/models", json=amr)
@@ -577,6 +1464,13 @@ def test_profile_model(
     assert (
         status_response.json().get("status") == "finished"
     ), f"The RQ job failed.\n{job.latest_result().exc_string}"
+    if settings.MOCK_TDS:
+        # Only the changed fields are sent to TDS
+        assert model_update.call_count == 0
+        assert [op["path"] for op in model_patch.last_request.json()] == [
+            "/description",
+            "/metadata",
+        ]
     #### POSTAMBLE ####
     if not settings.MOCK_TA1 and os.path.exists(
         f"{context_dir}/ground_truth_model_card.json"
@@ -633,12 +1527,19 @@ def test_link_amr(
     if settings.MOCK_TDS:
         http_mock.get(f"{settings.TDS_URL}/models/{model_id}", json=amr)
         http_mock.get(f"{settings.TDS_URL}/document-asset/{document_id}", json=document)
-        http_mock.put(f"{settings.TDS_URL}/models/{model_id}", json={"id": model_id})
+        model_update = http_mock.put(
+            f"{settings.TDS_URL}/models/{model_id}", json={"id": model_id}
+        )
+        model_patch = http_mock.patch(
+            f"{settings.TDS_URL}/models/{model_id}", json={"id": model_id}
+        )
 
     if settings.MOCK_TA1:
+        linked_amr = json.loads(json.dumps(amr))
+        linked_amr["model"]["states"][0]["description"] = "Linked description"
         http_mock.post(
             f"{settings.TA1_UNIFIED_URL}/metal/link_amr",
-            json=amr,
+            json=linked_amr,
         )
 
     query_params = {"model_id": model_id, "document_id": document_id}
@@ -666,4 +1567,11 @@ def test_link_amr(
         status_response.json().get("status") == "finished"
     ), f"The RQ job failed.\n{job.latest_result().exc_string}"
 
+    if settings.MOCK_TDS and settings.MOCK_TA1:
+        # Only the linked state is sent to TDS, without a missing card
+        assert model_update.call_count == 0
+        assert [op["path"] for op in model_patch.last_request.json()] == [
+            "/model/states/0/description"
+        ]
+
     assert amr_instance.is_valid()
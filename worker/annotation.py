@@ -0,0 +1,140 @@
+"""
+Chunked text annotation for long documents.
+
+SKEMA and MIT struggle with whole papers, so with `ANNOTATION_CHUNK_CHARS` set
+the document text is split on paragraph (or, failing that, line and sentence)
+boundaries, each chunk is annotated concurrently and the resulting attribute
+collections are merged back together. Character offsets reported by the
+annotators are shifted by each chunk's offset so they point into the full
+document again.
+"""
+
+import copy
+import json
+import logging
+import time
+
+from lib.settings import settings
+from worker.utils import run_concurrently
+
+LOG_LEVEL = settings.LOG_LEVEL.upper()
+
+numeric_level = getattr(logging, LOG_LEVEL, None)
+if not isinstance(numeric_level, int):
+    raise ValueError(f"Invalid log level: {LOG_LEVEL}")
+
+logger = logging.getLogger(__name__)
+logger.setLevel(numeric_level)
+handler = logging.StreamHandler()
+formatter = logging.Formatter(
+    "%(asctime)s - %(name)s - %(levelname)s - [%(lineno)d] - %(message)s"
+)
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+# Preferred places to cut a chunk, best first
+BOUNDARIES = ["\n\n", "\n", ". "]
+OFFSET_FIELDS = ("char_start", "char_end")
+
+
+def chunk_text(text, max_chars):
+    """
+    Split `text` into (offset, chunk) pairs of at most `max_chars` characters,
+    cutting on the latest paragraph, line or sentence boundary available.
+    """
+    if max_chars <= 0 or len(text) <= max_chars:
+        return [(0, text)]
+
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(start + max_chars, len(text))
+        if end < len(text):
+            for boundary in BOUNDARIES:
+                cut = text.rfind(boundary, start, end)
+                if cut > start:
+                    end = cut + len(boundary)
+                    break
+        chunks.append((start, text[start:end]))
+        start = end
+    return chunks
+
+
+def offset_extraction_sources(data, offset):
+    """
+    Shift every character offset found in an extraction by `offset`, in place.
+    """
+    if isinstance(data, dict):
+        for key, value in data.items():
+            if key in OFFSET_FIELDS and isinstance(value, int):
+                data[key] = value + offset
+            else:
+                offset_extraction_sources(value, offset)
+    elif isinstance(data, list):
+        for value in data:
+            offset_extraction_sources(value, offset)
+    return data
+
+
+def merge_attributes(collections):
+    """
+    Concatenate the attributes of several collections, dropping exact duplicates
+    such as the document collection every chunk reports.
+    """
+    seen = set()
+    attributes = []
+    for collection in collections:
+        for attribute in collection.get("attributes", []):
+            key = json.dumps(attribute, sort_keys=True)
+            if key not in seen:
+                seen.add(key)
+                attributes.append(attribute)
+    return attributes
+
+
+def annotate_in_chunks(annotate, text, get_data):
+    """
+    Run `annotate(text)` over the chunks of `text` and merge the results.
+
+    `annotate` returns a (response, json, latency) tuple as `skema_annotation`
+    and `mit_annotation` do, and `get_data` picks the attribute collection out
+    of that json. The merged result has the same shape, with the response of
+    the first failed chunk (if any) and the overall wall time, followed by the
+    number of chunks that failed.
+    """
+    chunks = chunk_text(text, settings.ANNOTATION_CHUNK_CHARS)
+    if len(chunks) == 1:
+        return (*annotate(text), 0)
+
+    logger.info(f"Annotating {len(text)} characters in {len(chunks)} chunks")
+    started = time.perf_counter()
+    results = run_concurrently(
+        lambda chunk: annotate(chunk[1]),
+        chunks,
+        max_workers=settings.ANNOTATION_CONCURRENCY,
+    )
+
+    collections = []
+    template = None
+    failed_response = None
+    failed = 0
+    for (offset, _), (response, extraction_json, _) in zip(chunks, results):
+        try:
+            data = get_data(extraction_json)
+            if not isinstance(data.get("attributes"), list):
+                raise ValueError("response has no attributes")
+            collections.append(offset_extraction_sources(data, offset))
+            template = template or extraction_json
+        except Exception as e:
+            logger.error(f"Annotation of chunk at offset {offset} failed: {e}")
+            failed += 1
+            if failed_response is None:
+                failed_response = response
+
+    if template is None:
+        return failed_response, None, time.perf_counter() - started, failed
+
+    merged = copy.deepcopy(template)
+    get_data(merged)["attributes"] = merge_attributes(collections)
+    response = failed_response if failed_response is not None else results[0][0]
+    return response, merged, time.perf_counter() - started, failed
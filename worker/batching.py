@@ -0,0 +1,150 @@
+"""
+Micro-batching of SKEMA text reading requests.
+
+SKEMA's integrated text extraction endpoint takes a list of texts, so with
+`SKEMA_BATCH_WINDOW` set, texts submitted by concurrent annotations in the same
+worker process (threaded worker jobs, document chunks) are collected for up to
+that many seconds, or until `SKEMA_BATCH_MAX_SIZE` texts are waiting, and sent
+in a single request. The first text of a batch is sent by the thread that
+submitted it; the others wait for it and get their own entry of `outputs`.
+
+The batcher lives in the worker process, so texts of different jobs are only
+batched under `python -m worker.threaded`. The default worker image forks a
+work-horse per job, where only the chunks of one document share a batch.
+
+Batch sizes are counted in the Redis hash `skema-batcher:stats`
+(`batches`, `texts` and one `size:<n>` counter per batch size).
+"""
+
+import logging
+import threading
+
+import requests
+from redis import Redis
+
+from lib.settings import settings
+
+LOG_LEVEL = settings.LOG_LEVEL.upper()
+
+numeric_level = getattr(logging, LOG_LEVEL, None)
+if not isinstance(numeric_level, int):
+    raise ValueError(f"Invalid log level: {LOG_LEVEL}")
+
+logger = logging.getLogger(__name__)
+logger.setLevel(numeric_level)
+handler = logging.StreamHandler()
+formatter = logging.Formatter(
+    "%(asctime)s - %(name)s - %(levelname)s - [%(lineno)d] - %(message)s"
+)
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+STATS_KEY = "skema-batcher:stats"
+
+
+class _Batch:
+    def __init__(self):
+        self.texts = []
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.response = None
+        self.outputs = None
+        self.error = None
+
+
+class SkemaBatcher:
+    def __init__(self, url, window, max_size, timeout=None, connection=None):
+        self.url = url
+        self.window = window
+        self.max_size = max_size
+        self.timeout = timeout
+        self.connection = connection
+        self.lock = threading.Lock()
+        self.pending = None
+
+    def submit(self, text):
+        """
+        Annotate `text` as part of the next batch.
+
+        Returns the shared SKEMA response and a response body holding only this
+        text's output, shaped like the body of a single-text request.
+        """
+        with self.lock:
+            batch = self.pending
+            leader = batch is None
+            if leader:
+                batch = self.pending = _Batch()
+            index = len(batch.texts)
+            batch.texts.append(text)
+            if len(batch.texts) >= self.max_size:
+                self.pending = None
+                batch.full.set()
+
+        if leader:
+            batch.full.wait(self.window)
+            with self.lock:
+                if self.pending is batch:
+                    self.pending = None
+            self.send(batch)
+        else:
+            # The leader waits out the window before sending its request
+            wait = None if self.timeout is None else self.window + self.timeout
+            if not batch.done.wait(wait):
+                raise TimeoutError(f"SKEMA batch was not sent within {wait} seconds")
+
+        if batch.error is not None:
+            raise batch.error
+        outputs = batch.outputs.get("outputs") if isinstance(batch.outputs, dict) else None
+        if not outputs or len(outputs) <= index:
+            # Error bodies are passed through as they are
+            return batch.response, batch.outputs
+        return batch.response, {
+            "outputs": [outputs[index]],
+            "generalized_errors": batch.outputs.get("generalized_errors"),
+        }
+
+    def send(self, batch):
+        try:
+            logger.info(f"Sending batch of {len(batch.texts)} texts to SKEMA")
+            batch.response = requests.post(
+                self.url, json={"texts": batch.texts}, timeout=self.timeout
+            )
+            batch.outputs = batch.response.json()
+        except Exception as e:
+            batch.error = e
+        finally:
+            batch.done.set()
+        self.record(len(batch.texts))
+
+    def record(self, size):
+        try:
+            connection = self.connection or Redis(settings.REDIS_HOST, settings.REDIS_PORT)
+            with connection.pipeline() as pipeline:
+                pipeline.hincrby(STATS_KEY, "batches", 1)
+                pipeline.hincrby(STATS_KEY, "texts", size)
+                pipeline.hincrby(STATS_KEY, f"size:{size}", 1)
+                pipeline.execute()
+        except Exception as e:
+            logger.warning(f"Could not record SKEMA batch size: {e}")
+
+
+_batcher = None
+_batcher_lock = threading.Lock()
+
+
+def get_skema_batcher(url):
+    """
+    The process-wide batcher, or None when batching is off.
+    """
+    global _batcher
+    if settings.SKEMA_BATCH_WINDOW <= 0:
+        return None
+    with _batcher_lock:
+        if _batcher is None:
+            _batcher = SkemaBatcher(
+                url,
+                window=settings.SKEMA_BATCH_WINDOW,
+                max_size=settings.SKEMA_BATCH_MAX_SIZE,
+                timeout=settings.SKEMA_ANNOTATION_TIMEOUT,
+            )
+    return _batcher
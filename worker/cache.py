@@ -0,0 +1,214 @@
+"""
+Content-addressed result cache shared by the worker operations.
+
+Entries are JSON documents stored under a namespace (one per operation) in
+either a local directory or Redis, selected with `CACHE_BACKEND`
+("disk", "redis" or "none"). Each namespace is bounded to `CACHE_MAX_BYTES`
+and evicts its least recently used entries first. Hit and miss counters are
+kept in the backend so they add up across forked work-horses.
+"""
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from redis import Redis
+
+from lib.settings import settings
+
+LOG_LEVEL = settings.LOG_LEVEL.upper()
+
+numeric_level = getattr(logging, LOG_LEVEL, None)
+if not isinstance(numeric_level, int):
+    raise ValueError(f"Invalid log level: {LOG_LEVEL}")
+
+logger = logging.getLogger(__name__)
+logger.setLevel(numeric_level)
+handler = logging.StreamHandler()
+formatter = logging.Formatter(
+    "%(asctime)s - %(name)s - %(levelname)s - [%(lineno)d] - %(message)s"
+)
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+
+def content_hash(*parts):
+    """
+    SHA-256 over the given parts. Bytes are hashed as they are, anything else
+    as canonical JSON.
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = json.dumps(part, sort_keys=True, default=str).encode()
+        # Hash each part separately so ("ab", "c") and ("a", "bc") differ
+        digest.update(hashlib.sha256(part).digest())
+    return digest.hexdigest()
+
+
+class DiskBackend:
+    STATS_FILE = ".stats"
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def get(self, key):
+        path = os.path.join(self.directory, key)
+        try:
+            with open(path, "rb") as f:
+                value = f.read()
+        except FileNotFoundError:
+            return None
+        # The modification time doubles as the last access time for eviction
+        os.utime(path)
+        return value
+
+    def set(self, key, value):
+        path = os.path.join(self.directory, key)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(value)
+        os.replace(temp_path, path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith(".") or entry.name.endswith(".tmp"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def incr(self, name):
+        with open(os.path.join(self.directory, self.STATS_FILE), "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            stats = json.loads(f.read() or "{}")
+            stats[name] = stats.get(name, 0) + 1
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps(stats))
+
+    def stats(self):
+        try:
+            with open(os.path.join(self.directory, self.STATS_FILE)) as f:
+                return json.loads(f.read() or "{}")
+        except FileNotFoundError:
+            return {}
+
+
+class RedisBackend:
+    def __init__(self, connection, namespace, max_bytes):
+        self.connection = connection
+        self.prefix = f"km-cache:{namespace}"
+        self.max_bytes = max_bytes
+
+    def get(self, key):
+        value = self.connection.get(f"{self.prefix}:{key}")
+        if value is not None:
+            self.connection.zadd(f"{self.prefix}:lru", {key: time.time()})
+        return value
+
+    def set(self, key, value):
+        with self.connection.pipeline() as pipeline:
+            pipeline.set(f"{self.prefix}:{key}", value)
+            pipeline.zadd(f"{self.prefix}:lru", {key: time.time()})
+            pipeline.hset(f"{self.prefix}:sizes", key, len(value))
+            pipeline.execute()
+        self.evict()
+
+    def evict(self):
+        sizes = self.connection.hgetall(f"{self.prefix}:sizes")
+        total = sum(int(size) for size in sizes.values())
+        while total > self.max_bytes:
+            oldest = self.connection.zrange(f"{self.prefix}:lru", 0, 0)
+            if not oldest:
+                break
+            key = oldest[0].decode()
+            with self.connection.pipeline() as pipeline:
+                pipeline.delete(f"{self.prefix}:{key}")
+                pipeline.zrem(f"{self.prefix}:lru", key)
+                pipeline.hdel(f"{self.prefix}:sizes", key)
+                pipeline.execute()
+            total -= int(sizes.get(key.encode(), 0))
+
+    def incr(self, name):
+        self.connection.hincrby(f"{self.prefix}:stats", name, 1)
+
+    def stats(self):
+        return {
+            name.decode(): int(count)
+            for name, count in self.connection.hgetall(f"{self.prefix}:stats").items()
+        }
+
+
+class Cache:
+    """
+    JSON cache for one namespace. Backend failures are logged and treated as
+    misses so a broken cache never fails a job.
+    """
+
+    def __init__(self, namespace, backend):
+        self.namespace = namespace
+        self.backend = backend
+
+    def get(self, key):
+        try:
+            value = self.backend.get(key)
+            self.backend.incr("hits" if value is not None else "misses")
+        except Exception as e:
+            logger.warning(f"Cache {self.namespace} lookup failed: {e}")
+            return None
+
+        logger.info(
+            f"Cache {self.namespace} {'hit' if value is not None else 'miss'} for {key}"
+        )
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value):
+        try:
+            self.backend.set(key, json.dumps(value, default=str).encode())
+        except Exception as e:
+            logger.warning(f"Cache {self.namespace} write failed: {e}")
+
+    def stats(self):
+        return self.backend.stats()
+
+
+def get_cache(namespace):
+    """
+    Cache for `namespace` on the configured backend, or None when caching is off.
+    """
+    match settings.CACHE_BACKEND:
+        case "disk":
+            backend = DiskBackend(
+                os.path.join(settings.CACHE_DIR, namespace), settings.CACHE_MAX_BYTES
+            )
+        case "redis":
+            backend = RedisBackend(
+                Redis(settings.REDIS_HOST, settings.REDIS_PORT),
+                namespace,
+                settings.CACHE_MAX_BYTES,
+            )
+        case _:
+            return None
+    return Cache(namespace, backend)
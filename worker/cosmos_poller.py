@@ -0,0 +1,182 @@
+"""
+Centralised Cosmos status poller.
+
+With `COSMOS_ASYNC_POLLING` enabled, `pdf_extraction` only submits the PDF to
+Cosmos and registers the job here, freeing its worker immediately. A single
+poller process tracks every outstanding `status_endpoint` in one event loop,
+backing off each job's polling interval while it is running, and enqueues
+`pdf_extraction_continuation` to download and upload the results once Cosmos
+reports the job as completed (or failed, or timed out).
+
+Usage:
+    python -m worker.cosmos_poller
+"""
+
+import asyncio
+import json
+import logging
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from redis import Redis
+from rq import Queue
+from rq.exceptions import NoSuchJobError
+from rq.job import Job, JobStatus
+from rq.registry import DeferredJobRegistry
+
+from lib.auth import http_session
+from lib.settings import settings
+
+LOG_LEVEL = settings.LOG_LEVEL.upper()
+
+numeric_level = getattr(logging, LOG_LEVEL, None)
+if not isinstance(numeric_level, int):
+    raise ValueError(f"Invalid log level: {LOG_LEVEL}")
+
+logger = logging.getLogger(__name__)
+logger.setLevel(numeric_level)
+handler = logging.StreamHandler()
+formatter = logging.Formatter(
+    "%(asctime)s - %(name)s - %(levelname)s - [%(lineno)d] - %(message)s"
+)
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+PENDING_KEY = "cosmos-poller:pending"
+CONTINUATION_FUNC = "worker.operations.pdf_extraction_continuation"
+TICK_SECONDS = 1
+STATUS_TIMEOUT = 30
+
+
+def get_redis():
+    return Redis(settings.REDIS_HOST, settings.REDIS_PORT)
+
+
+def register(status_endpoint, continuation_kwargs, connection=None, queue_name="default"):
+    """
+    Hand a submitted Cosmos job to the poller, returning the id of the
+    continuation job.
+
+    The continuation is created right away as a deferred job, so its status can
+    be followed before the poller enqueues it.
+    """
+    connection = connection or get_redis()
+    continuation_job_id = f"pdf-extraction-continuation-{uuid.uuid4()}"
+    queue = Queue(queue_name, connection=connection, default_timeout=-1)
+    job = queue.create_job(
+        CONTINUATION_FUNC,
+        kwargs=continuation_kwargs,
+        job_id=continuation_job_id,
+        status=JobStatus.DEFERRED,
+    )
+    job.save()
+    DeferredJobRegistry(queue=queue).add(job)
+
+    entry = {
+        "status_endpoint": status_endpoint,
+        "queue": queue_name,
+        "kwargs": continuation_kwargs,
+        "submitted_at": time.time(),
+    }
+    connection.hset(PENDING_KEY, continuation_job_id, json.dumps(entry))
+    return continuation_job_id
+
+
+class CosmosPoller:
+    def __init__(self, connection=None):
+        self.connection = connection or get_redis()
+        self.executor = ThreadPoolExecutor(settings.COSMOS_POLLER_CONCURRENCY)
+        # continuation job id -> (next poll time, current interval)
+        self.schedule = {}
+
+    def load(self):
+        """
+        Sync the in-memory schedule with the jobs registered in Redis.
+        """
+        pending = {
+            key.decode(): json.loads(value)
+            for key, value in self.connection.hgetall(PENDING_KEY).items()
+        }
+        now = time.time()
+        for job_id in pending.keys() - self.schedule.keys():
+            self.schedule[job_id] = (now, settings.COSMOS_POLL_INTERVAL)
+        for job_id in self.schedule.keys() - pending.keys():
+            del self.schedule[job_id]
+        return pending
+
+    def complete(self, job_id, entry, error=None):
+        queue = Queue(entry["queue"], connection=self.connection, default_timeout=-1)
+        kwargs = dict(entry["kwargs"], cosmos_error=error)
+        try:
+            job = Job.fetch(job_id, connection=self.connection)
+        except NoSuchJobError:
+            queue.enqueue_call(func=CONTINUATION_FUNC, kwargs=kwargs, job_id=job_id)
+        else:
+            DeferredJobRegistry(queue=queue).remove(job)
+            # Reading the kwargs loads the job data before it is replaced
+            job.kwargs = dict(job.kwargs, cosmos_error=error)
+            job.set_status(JobStatus.QUEUED)
+            queue.enqueue_job(job)
+        self.connection.hdel(PENDING_KEY, job_id)
+        del self.schedule[job_id]
+        logger.info(f"Enqueued {job_id} for Cosmos job {kwargs.get('cosmos_job_id')}")
+
+    async def check(self, job_id, entry):
+        loop = asyncio.get_running_loop()
+        try:
+            status = await loop.run_in_executor(
+                self.executor,
+                lambda: http_session().get(entry["status_endpoint"], timeout=STATUS_TIMEOUT),
+            )
+            status_data = status.json()
+            error, completed = status_data["error"], status_data["job_completed"]
+        except Exception as e:
+            # Treat failed polls and unexpected bodies (e.g. a 404 detail) as
+            # "still running" and retry after backing off
+            logger.warning(f"Polling {entry['status_endpoint']} failed: {e!r}")
+            error, completed = None, False
+
+        elapsed = time.time() - entry["submitted_at"]
+        if error or completed:
+            self.complete(job_id, entry, error=error)
+        elif elapsed > settings.COSMOS_MAX_EXECUTION_TIME:
+            self.complete(
+                job_id,
+                entry,
+                error=f"Job not complete after {settings.COSMOS_MAX_EXECUTION_TIME} seconds.",
+            )
+        else:
+            _, interval = self.schedule[job_id]
+            interval = min(
+                interval * settings.COSMOS_POLL_BACKOFF,
+                settings.COSMOS_POLL_MAX_INTERVAL,
+            )
+            self.schedule[job_id] = (time.time() + interval, interval)
+
+    async def poll_due(self):
+        """
+        Poll every registered job whose next poll time has passed.
+        """
+        pending = self.load()
+        now = time.time()
+        due = [
+            job_id
+            for job_id, (next_poll, _) in self.schedule.items()
+            if next_poll <= now
+        ]
+        await asyncio.gather(*(self.check(job_id, pending[job_id]) for job_id in due))
+        return len(due)
+
+    async def run(self):
+        logger.info("Cosmos poller started")
+        while True:
+            try:
+                await self.poll_due()
+            except Exception as e:
+                logger.error(f"Cosmos poller tick failed: {e}")
+            await asyncio.sleep(TICK_SECONDS)
+
+
+if __name__ == "__main__":
+    asyncio.run(CosmosPoller().run())
@@ -0,0 +1,151 @@
+"""
+Local merge of variable extractions.
+
+Replaces the MIT `/integration/get_mapping` round trip for de-duplicating the
+SKEMA and MIT attribute collections. Anchored entities are indexed by their
+normalised primary name, best grounding identifier and text spans; entities that
+share any of those keys are merged with a union-find, so the whole merge is a
+single pass over the attributes. Scenario contexts pointing at a merged entity
+are re-pointed at the entity it was merged into.
+
+The merge works on the JSON form of the collections and only builds the
+pydantic `AttributeCollection` once at the end.
+"""
+
+import json
+import re
+
+ENTITY_TYPE = "anchored_entity"
+CONTEXT_TYPE = "scenario_context"
+ENTITY_LISTS = ("mentions", "text_descriptions", "value_descriptions", "groundings")
+GROUNDING_MIN_SCORE = 0.9
+
+_NON_WORD = re.compile(r"[\W_]+")
+
+
+def normalise_name(name):
+    return _NON_WORD.sub("", name or "").lower()
+
+
+def entity_keys(payload):
+    """
+    Keys under which an anchored entity can be matched with another one.
+    """
+    keys = set()
+    mentions = payload.get("mentions") or []
+    # Only the primary name: entities whose mentions already link different
+    # symbols would otherwise chain unrelated variables together
+    if mentions:
+        name = normalise_name(mentions[0].get("name"))
+        if name:
+            keys.add(("name", name))
+    for mention in mentions:
+        source = mention.get("extraction_source") or {}
+        if source.get("char_start") is not None:
+            document = (source.get("document_reference") or {}).get("id")
+            keys.add(("span", document, source["char_start"], source.get("char_end")))
+    # Embedding groundings of short symbols are noisy, so only a confident
+    # best grounding identifies an entity
+    groundings = payload.get("groundings") or []
+    if groundings:
+        grounding = max(groundings, key=lambda g: g.get("score") or 0)
+        score = grounding.get("score") or 0
+        if grounding.get("grounding_id") and score >= GROUNDING_MIN_SCORE:
+            keys.add(("grounding", grounding["grounding_id"]))
+    return keys
+
+
+def _entity_id(attribute):
+    return ((attribute.get("payload") or {}).get("id") or {}).get("id")
+
+
+def _find(parents, i):
+    while parents[i] != i:
+        parents[i] = parents[parents[i]]
+        i = parents[i]
+    return i
+
+
+def _extend_unique(target, items, seen):
+    for item in items or []:
+        key = json.dumps(item, sort_keys=True)
+        if key not in seen:
+            seen.add(key)
+            target.append(item)
+
+
+def merge_variable_attributes(*collections):
+    """
+    Merge the attributes of several collections (as JSON dicts) into one list.
+    """
+    attributes = [
+        attribute
+        for collection in collections
+        for attribute in (collection or {}).get("attributes") or []
+    ]
+
+    # Union anchored entities that share any key
+    entities = [i for i, a in enumerate(attributes) if a.get("type") == ENTITY_TYPE]
+    parents = {i: i for i in entities}
+    owners = {}
+    for i in entities:
+        for key in entity_keys(attributes[i].get("payload") or {}):
+            if key in owners:
+                root, other = _find(parents, i), _find(parents, owners[key])
+                if root != other:
+                    parents[max(root, other)] = min(root, other)
+            else:
+                owners[key] = i
+
+    merged = []
+    merged_entities = {}
+    renamed_ids = {}
+    for i, attribute in enumerate(attributes):
+        if attribute.get("type") != ENTITY_TYPE:
+            merged.append(attribute)
+            continue
+
+        root = _find(parents, i)
+        if root not in merged_entities:
+            payload = dict(attribute.get("payload") or {})
+            for field in ENTITY_LISTS:
+                payload[field] = []
+            merged_entities[root] = (
+                dict(attribute, payload=payload),
+                {field: set() for field in ENTITY_LISTS},
+            )
+            merged.append(merged_entities[root][0])
+
+        target, target_seen = merged_entities[root]
+        for field in ENTITY_LISTS:
+            _extend_unique(
+                target["payload"][field],
+                (attribute.get("payload") or {}).get(field),
+                target_seen[field],
+            )
+        if root != i:
+            renamed_ids[_entity_id(attribute)] = _entity_id(target)
+
+    deduplicated = []
+    seen = set()
+    for attribute in merged:
+        if attribute.get("type") == ENTITY_TYPE:
+            deduplicated.append(attribute)
+            continue
+
+        # Point scenario contexts at the entities that survived the merge
+        payload = attribute.get("payload") or {}
+        if attribute.get("type") == CONTEXT_TYPE and payload.get("extractions"):
+            extractions = []
+            for extraction in payload["extractions"]:
+                extraction_id = renamed_ids.get(extraction.get("id"), extraction.get("id"))
+                if all(e.get("id") != extraction_id for e in extractions):
+                    extractions.append(dict(extraction, id=extraction_id))
+            attribute = dict(attribute, payload=dict(payload, extractions=extractions))
+
+        key = json.dumps(attribute, sort_keys=True)
+        if key not in seen:
+            seen.add(key)
+            deduplicated.append(attribute)
+
+    return deduplicated
@@ -0,0 +1,259 @@
+"""
+Partial, serialised model updates in TDS.
+
+`update_model_in_tds` takes the model as it was read from TDS and the updated
+model, and sends only the JSON Patch (RFC 6902) between the two. Writes to one
+model go through Redis: each update is queued under `model-writes:<model_id>`
+and whichever job holds the model's write lock sends every queued patch in a
+single request, so concurrent enrichments of the same model (`model_card`,
+`link_amr`) are coalesced instead of overwriting each other.
+
+If TDS does not take the patch (or `TDS_MODEL_PATCH` is off), the current model
+is read again, the queued patches are applied to it locally and it is PUT back
+in full.
+"""
+
+import json
+import logging
+import time
+import uuid
+
+from redis import Redis, WatchError
+
+from lib.auth import auth_session
+from lib.settings import settings
+
+LOG_LEVEL = settings.LOG_LEVEL.upper()
+
+numeric_level = getattr(logging, LOG_LEVEL, None)
+if not isinstance(numeric_level, int):
+    raise ValueError(f"Invalid log level: {LOG_LEVEL}")
+
+logger = logging.getLogger(__name__)
+logger.setLevel(numeric_level)
+handler = logging.StreamHandler()
+formatter = logging.Formatter(
+    "%(asctime)s - %(name)s - %(levelname)s - [%(lineno)d] - %(message)s"
+)
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+TDS_API = settings.TDS_URL
+KEY_PREFIX = "model-writes"
+RESULT_TTL = 3600
+POLL_INTERVAL = 0.05
+
+
+def _pointer(path):
+    return "".join(
+        "/" + str(token).replace("~", "~0").replace("/", "~1") for token in path
+    )
+
+
+def _tokens(pointer):
+    return [
+        token.replace("~1", "/").replace("~0", "~") for token in pointer.split("/")[1:]
+    ]
+
+
+def json_diff(source, target, path=()):
+    """
+    JSON Patch turning `source` into `target`.
+
+    Objects are compared key by key and lists of the same length item by
+    item; anything else that differs is replaced as a whole.
+    """
+    if source == target:
+        return []
+    if isinstance(source, dict) and isinstance(target, dict):
+        operations = []
+        for key in source:
+            if key not in target:
+                operations.append({"op": "remove", "path": _pointer(path + (key,))})
+        for key, value in target.items():
+            if key not in source:
+                operations.append(
+                    {"op": "add", "path": _pointer(path + (key,)), "value": value}
+                )
+            else:
+                operations.extend(json_diff(source[key], value, path + (key,)))
+        return operations
+    if isinstance(source, list) and isinstance(target, list) and len(source) == len(target):
+        operations = []
+        for index, (old, new) in enumerate(zip(source, target)):
+            operations.extend(json_diff(old, new, path + (index,)))
+        return operations
+    return [{"op": "replace", "path": _pointer(path), "value": target}]
+
+
+def apply_patch(document, operations):
+    """
+    Apply JSON Patch operations to `document` in place and return it.
+
+    Operations whose parent no longer exists are skipped, so patches made
+    against an older version of the model still apply to the latest one.
+    """
+    for operation in operations:
+        tokens = _tokens(operation["path"])
+        if not tokens:
+            document = operation.get("value")
+            continue
+
+        parent = document
+        try:
+            for token in tokens[:-1]:
+                parent = parent[int(token) if isinstance(parent, list) else token]
+        except (KeyError, IndexError, ValueError, TypeError):
+            logger.debug(f"Skipping patch operation on missing path {operation['path']}")
+            continue
+
+        key = tokens[-1]
+        if isinstance(parent, list):
+            index = len(parent) if key == "-" else int(key)
+            if operation["op"] == "add":
+                parent.insert(index, operation["value"])
+            elif index < len(parent):
+                if operation["op"] == "replace":
+                    parent[index] = operation["value"]
+                else:
+                    del parent[index]
+        elif isinstance(parent, dict):
+            if operation["op"] == "remove":
+                parent.pop(key, None)
+            else:
+                parent[key] = operation["value"]
+    return document
+
+
+def _acquire(connection, lock_key, token):
+    return connection.set(
+        lock_key, token, nx=True, px=int(settings.MODEL_WRITE_LOCK_TIMEOUT * 1000)
+    )
+
+
+def _release(connection, lock_key, token):
+    with connection.pipeline() as pipeline:
+        try:
+            pipeline.watch(lock_key)
+            if pipeline.get(lock_key) == token.encode():
+                pipeline.multi()
+                pipeline.delete(lock_key)
+                pipeline.execute()
+            else:
+                pipeline.unwatch()
+        except WatchError:
+            pass
+
+
+def _write(model_id, operations):
+    """
+    Send the patch to TDS, falling back to a full PUT. Returns 200 once either
+    write succeeded (TDS may answer a patch with 202 or 204), or the status code
+    of the failed request.
+    """
+    tds_model_url = f"{TDS_API}/models/{model_id}"
+
+    if settings.TDS_MODEL_PATCH:
+        try:
+            response = auth_session().patch(
+                tds_model_url,
+                data=json.dumps(operations, default=str),
+                headers={"Content-Type": "application/json-patch+json"},
+            )
+            if response.status_code < 300:
+                logger.info(
+                    f"Patched model {model_id} in TDS with {len(operations)} operations"
+                )
+                return 200
+            logger.info(
+                f"TDS did not take the patch for model {model_id} ({response.status_code}), sending the full model"
+            )
+        except Exception as e:
+            # A full PUT of the patched model is safe to send even if the patch landed
+            logger.info(f"Patching model {model_id} failed ({e}), sending the full model")
+
+    model_response = auth_session().get(tds_model_url)
+    if model_response.status_code != 200:
+        return model_response.status_code
+    model = apply_patch(model_response.json(), operations)
+    response = auth_session().put(tds_model_url, json=model)
+    return 200 if response.status_code < 300 else response.status_code
+
+
+def update_model_in_tds(model_id, model, updated, connection=None):
+    """
+    Write the difference between `model` (as read from TDS) and `updated` to
+    the TDS model `model_id`, see the module docstring.
+
+    Any `amr_hash` kept in the model metadata is removed, so `put_amr_to_tds`
+    won't take the patched model for the AMR it stored.
+
+    Returns the status code of the (possibly shared) write, or 200 if there is
+    nothing to change.
+    """
+    # A hash stored by `put_amr_to_tds` no longer describes the updated model
+    metadata = updated.get("metadata")
+    if isinstance(metadata, dict) and "amr_hash" in metadata:
+        updated = dict(
+            updated,
+            metadata={key: value for key, value in metadata.items() if key != "amr_hash"},
+        )
+
+    operations = json_diff(model, updated)
+    if not operations:
+        logger.info(f"Model {model_id} is unchanged, skipping update")
+        return 200
+
+    connection = connection or Redis(settings.REDIS_HOST, settings.REDIS_PORT)
+    key = f"{KEY_PREFIX}:{model_id}"
+    entry_id = uuid.uuid4().hex
+    entry = json.dumps({"id": entry_id, "operations": operations}, default=str)
+    connection.rpush(f"{key}:pending", entry)
+
+    token = uuid.uuid4().hex
+    # The entry may have to wait for the write in flight (at most one lock
+    # timeout) before it is written itself (at most another one)
+    deadline = time.monotonic() + 2 * settings.MODEL_WRITE_LOCK_TIMEOUT
+    while time.monotonic() < deadline:
+        status = connection.hget(f"{key}:results", entry_id)
+        if status is not None:
+            return int(status)
+
+        if not _acquire(connection, f"{key}:lock", token):
+            time.sleep(POLL_INTERVAL)
+            continue
+        try:
+            with connection.pipeline() as pipeline:
+                pipeline.lrange(f"{key}:pending", 0, -1)
+                pipeline.delete(f"{key}:pending")
+                entries, _ = pipeline.execute()
+            if not entries:
+                continue
+            entries = [json.loads(entry) for entry in entries]
+            if len(entries) > 1:
+                logger.info(f"Coalescing {len(entries)} updates of model {model_id}")
+
+            try:
+                status = _write(
+                    model_id,
+                    [op for entry in entries for op in entry["operations"]],
+                )
+            except Exception as e:
+                logger.error(f"Failed to update model {model_id} in TDS: {e}")
+                status = 500
+            with connection.pipeline() as pipeline:
+                pipeline.hset(
+                    f"{key}:results", mapping={entry["id"]: status for entry in entries}
+                )
+                pipeline.expire(f"{key}:results", RESULT_TTL)
+                pipeline.execute()
+        finally:
+            _release(connection, f"{key}:lock", token)
+
+    # Withdraw the patch so no later lock holder writes it after this job failed
+    if not connection.lrem(f"{key}:pending", 1, entry):
+        # Another job has already taken it and may have finished the write
+        status = connection.hget(f"{key}:results", entry_id)
+        if status is not None:
+            return int(status)
+    raise Exception(f"Timed out waiting to update model {model_id} in TDS")
@@ -1,28 +1,41 @@
+import copy
 import io
 import itertools as it
 import json
 import os
 import sys
-import tempfile
 import time
 import requests
 import zipfile
 
-import pandas
-
 from askem_extractions.data_model import AttributeCollection
-
-from lib.auth import auth_session
+from pypdf import PdfReader, PdfWriter
+from rq.connections import get_current_connection
+
+from lib.auth import auth_session, http_session
+from worker import cosmos_poller
+from worker.annotation import annotate_in_chunks, chunk_text
+from worker.batching import get_skema_batcher
+from worker.cache import content_hash, get_cache
+from worker.merge import merge_variable_attributes
+from worker.model_updates import update_model_in_tds
+from worker.profiling import profile_frames
 from worker.utils import (
+    copy_document_file,
     find_source_code,
     get_code_from_tds,
-    get_document_from_tds,
-    get_dataset_from_tds,
+    get_document_content_from_tds,
+    get_document_metadata_from_tds,
+    combine_dataset_files,
+    download_dataset_from_tds,
+    iter_dataset_frames,
     get_model_from_tds,
     put_amr_to_tds,
     put_code_extraction_to_tds,
     put_document_extraction_to_tds,
+    run_concurrently,
     set_provenance,
+    SpooledFile,
 )
 from lib.settings import settings, ExtractionServices
 
@@ -50,14 +63,21 @@ logger.addHandler(handler)
 
 
 # Worker jobs for knowledge services
-def equations_to_amr(*args, **kwargs):
-    equation_type = kwargs.get("equation_type")
-    equations = kwargs.get("equations")
-    model = kwargs.get("model")
-    model_id = kwargs.get("model_id")
-    name = kwargs.get("name")
-    description = kwargs.get("description")
+def normalise_equations(equations):
+    """
+    Equations as hashed for the equations to AMR cache: runs of whitespace
+    don't change the parsed model.
+    """
+    return [" ".join(equation.split()) for equation in equations]
 
+
+def equations_amr_request(equation_type, equations, model):
+    """
+    Send equations to the SKEMA MathML or LaTeX to AMR service.
+
+    Returns the status code, the AMR (None if the response could not be
+    parsed) and the response text.
+    """
     if equation_type == "mathml":
         # PUT the mathml to the skema endpoint.
         logger.info("Processing mathml")
@@ -81,6 +101,7 @@ def equations_to_amr(*args, **kwargs):
         amr_response = requests.post(
             url, data=json.dumps(put_payload, default=str), headers=headers
         )
+    amr_json = None
     try:
         amr_json = amr_response.json()
         logger.debug(f"TA 1 response object: {amr_response}")
@@ -89,24 +110,154 @@ def equations_to_amr(*args, **kwargs):
             f"Failed to parse response from backend knowledge service: {amr_response.text}"
         )
 
-    if amr_response.status_code == 200 and amr_json:
+    return amr_response.status_code, amr_json, amr_response.text
+
+
+def convert_equations(equation_type, equations, model):
+    """
+    Convert equations to an AMR through the equations to AMR cache.
+
+    Returns the status code, the AMR, the response text and the cache status
+    ("hit", "miss" or None when caching is off).
+    """
+    cache = get_cache("equations_to_amr")
+    if not cache:
+        return (*equations_amr_request(equation_type, equations, model), None)
+
+    cache_key = content_hash(equation_type, model, normalise_equations(equations))
+    cached = cache.get(cache_key)
+    if cached:
+        return 200, cached, None, "hit"
+
+    status_code, amr_json, response_text = equations_amr_request(
+        equation_type, equations, model
+    )
+    if status_code == 200 and amr_json:
+        cache.set(cache_key, amr_json)
+    return status_code, amr_json, response_text, "miss"
+
+
+def equations_to_amr(*args, **kwargs):
+    equation_type = kwargs.get("equation_type")
+    equations = kwargs.get("equations")
+    model = kwargs.get("model")
+    model_id = kwargs.get("model_id")
+    name = kwargs.get("name")
+    description = kwargs.get("description")
+
+    status_code, amr_json, response_text, cache_status = convert_equations(
+        equation_type, equations, model
+    )
+
+    if status_code == 200 and amr_json:
         tds_responses = put_amr_to_tds(amr_json, name, description, model_id)
 
         response = {
-            "status_code": amr_response.status_code,
+            "status_code": status_code,
             "amr": amr_json,
             "tds_model_id": tds_responses.get("model_id"),
             "tds_configuration_id": tds_responses.get("configuration_id"),
+            "tds_model_unchanged": tds_responses.get("unchanged"),
             "error": None,
         }
+        if cache_status:
+            response["cache"] = cache_status
 
         return response
     else:
         raise Exception(
-            f"Error encountered converting equations to text: {amr_response.text}"
+            f"Error encountered converting equations to text: {response_text}"
         ) from None
 
 
+def equations_to_amr_batch(*args, **kwargs):
+    """
+    Convert many independent equation sets and store each AMR in TDS.
+
+    Identical sets are converted once, conversions and TDS writes run
+    concurrently, and a failing set is reported in its result rather than
+    failing the job. AMRs are left out of the results to keep them small.
+    """
+    equation_type = kwargs.get("equation_type")
+    equation_sets = kwargs.get("equation_sets")
+
+    def conversion_key(equation_set):
+        return (
+            equation_set.get("model", "petrinet"),
+            tuple(normalise_equations(equation_set["equations"])),
+        )
+
+    def convert(equation_set):
+        try:
+            return convert_equations(
+                equation_type,
+                equation_set["equations"],
+                equation_set.get("model", "petrinet"),
+            )
+        except Exception as e:
+            return None, None, str(e), None
+
+    unique_sets = {}
+    for equation_set in equation_sets:
+        unique_sets.setdefault(conversion_key(equation_set), equation_set)
+    conversions = dict(
+        zip(
+            unique_sets,
+            run_concurrently(
+                convert,
+                unique_sets.values(),
+                max_workers=settings.EQUATIONS_BATCH_CONCURRENCY,
+            ),
+        )
+    )
+    logger.info(
+        f"Converted {len(unique_sets)} unique equation sets out of {len(equation_sets)}"
+    )
+
+    def store(equation_set):
+        status_code, amr_json, response_text, cache_status = conversions[
+            conversion_key(equation_set)
+        ]
+        result = {
+            "status_code": status_code,
+            "tds_model_id": None,
+            "tds_configuration_id": None,
+            "tds_model_unchanged": None,
+            "cache": cache_status,
+            "error": None,
+        }
+        if status_code != 200 or not amr_json:
+            result["error"] = f"Error encountered converting equations to AMR: {response_text}"
+            return result
+
+        try:
+            # Sets sharing a conversion get their own copy to name
+            tds_responses = put_amr_to_tds(
+                copy.deepcopy(amr_json),
+                equation_set.get("name"),
+                equation_set.get("description"),
+                equation_set.get("model_id"),
+            )
+        except Exception as e:
+            result["error"] = f"Error storing AMR in TDS: {e}"
+            return result
+
+        result["tds_model_id"] = tds_responses.get("model_id")
+        result["tds_configuration_id"] = tds_responses.get("configuration_id")
+        result["tds_model_unchanged"] = tds_responses.get("unchanged")
+        return result
+
+    results = run_concurrently(
+        store, equation_sets, max_workers=settings.EQUATIONS_BATCH_CONCURRENCY
+    )
+
+    return {
+        "results": results,
+        "succeeded": sum(result["error"] is None for result in results),
+        "failed": sum(result["error"] is not None for result in results),
+    }
+
+
 def skema_extraction(document_id, filename, downloaded_document):
     # Try to feed text to the unified service
     unified_text_reading_url = f"{UNIFIED_API}/text-reading/cosmos_to_json"
@@ -136,11 +287,11 @@ def skema_extraction(document_id, filename, downloaded_document):
     return text, response.status_code, extraction_json
 
 
-def cosmos_extraction(document_id, filename, downloaded_document, force_run=False):
-    MAX_EXECTION_TIME = 600
-    POLLING_INTERVAL = 5
-    MAX_ITERATIONS = MAX_EXECTION_TIME // POLLING_INTERVAL
-
+def cosmos_submit(document_id, filename, downloaded_document, force_run=False):
+    """
+    Submit a PDF to Cosmos, returning the Cosmos job description
+    (`job_id`, `status_endpoint`, `result_endpoint`) and the response status code.
+    """
     cosmos_text_extraction_url = f"{settings.COSMOS_URL}/process/"
 
     put_payload = [
@@ -151,113 +302,235 @@ def cosmos_extraction(document_id, filename, downloaded_document, force_run=Fals
         "use_cache": (not force_run),
     }
 
+    logger.info(
+        f"Sending document to backend knowledge service with document id {document_id} at {cosmos_text_extraction_url}"
+    )
+    response = requests.post(
+        cosmos_text_extraction_url, files=put_payload, data=data_form
+    )
+    logger.info(
+        f"Response received from backend knowledge service with status code: {response.status_code}"
+    )
     try:
-        logger.info(
-            f"Sending document to backend knowledge service with document id {document_id} at {cosmos_text_extraction_url}"
+        cosmos_job = response.json()
+        logger.info("COSMOS response object: %s", cosmos_job)
+        cosmos_job["job_id"], cosmos_job["status_endpoint"], cosmos_job["result_endpoint"]
+    except (ValueError, KeyError) as e:
+        logger.error(f"Value Error: {e}")
+        raise Exception(
+            f"Extraction failure: {response.text}"
+            f"with status code {response.status_code}"
+        ) from None
+
+    return cosmos_job, response.status_code
+
+
+def cosmos_poll(status_endpoint):
+    """
+    Block until Cosmos reports the job behind `status_endpoint` as done.
+    """
+    MAX_ITERATIONS = int(settings.COSMOS_MAX_EXECUTION_TIME // settings.COSMOS_POLL_INTERVAL)
+
+    job_done = False
+
+    for i in range(MAX_ITERATIONS):
+        status = requests.get(status_endpoint)
+        status_data = status.json()
+        logger.info("Polled status endpoint %s times:\n%s", i + 1, status_data)
+        job_done = status_data["error"] or status_data["job_completed"]
+        if job_done:
+            break
+        time.sleep(settings.COSMOS_POLL_INTERVAL)
+
+    if not job_done:
+        logger.error(
+            "ERROR: Job not complete after %s seconds.",
+            settings.COSMOS_MAX_EXECUTION_TIME,
         )
-        response = requests.post(
-            cosmos_text_extraction_url, files=put_payload, data=data_form
+        raise Exception(
+            f"Job not complete after {settings.COSMOS_MAX_EXECUTION_TIME} seconds."
         )
-        logger.info(
-            f"Response received from backend knowledge service with status code: {response.status_code}"
+    elif status_data["error"]:
+        logger.error("An unexpected error occurred: %s", {status_data["error"]})
+        raise Exception(
+            f"An error occurred when processing in Cosmos: {status_data['error']}"
         )
-        extraction_json = response.json()
-        cosmos_job_id = extraction_json["job_id"]
-        logger.info("COSMOS response object: %s", extraction_json)
-        status_endpoint = extraction_json["status_endpoint"]
-        result_endpoint = f"{extraction_json['result_endpoint']}"
-        result_endpoint_text = f"{result_endpoint}/text"
-        equations_endpoint = f"{result_endpoint}/extractions/equations"
-        figures_endpoint = f"{result_endpoint}/extractions/figures"
-        tables_endpoint = f"{result_endpoint}/extractions/tables"
-
-        job_done = False
-
-        for i in range(MAX_ITERATIONS):
-            status = requests.get(status_endpoint)
-            status_data = status.json()
-            logger.info("Polled status endpoint %s times:\n%s", i + 1, status_data)
-            job_done = status_data["error"] or status_data["job_completed"]
-            if job_done:
-                break
-            time.sleep(POLLING_INTERVAL)
-
-        if not job_done:
-            logger.error("ERROR: Job not complete after %s seconds.", MAX_EXECTION_TIME)
-            raise Exception(f"Job not complete after {MAX_EXECTION_TIME} seconds.")
-        elif status_data["error"]:
-            logger.error("An unexpected error occurred: %s", {status_data["error"]})
-            raise Exception(
-                f"An error occurred when processing in Cosmos: {status_data['error']}"
-            )
 
-        logger.info(f"Getting Cosmos extraction request from {result_endpoint_text}")
-        text_extractions_result = requests.get(result_endpoint_text)
-        logger.info(
-            f"Cosmos response status code: {text_extractions_result.status_code}"
+
+COSMOS_ASSET_TYPES = {"equation": "equations", "figure": "figures", "table": "tables"}
+COSMOS_TEXT_FIELDS = [
+    "pdf_name",
+    "page_num",
+    "bounding_box",
+    "detect_score",
+    "content",
+    "postprocess_score",
+    "detect_cls",
+    "postprocess_cls",
+]
+COSMOS_ASSET_FIELDS = [
+    "pdf_name",
+    "page_num",
+    "bounding_box",
+    "detect_score",
+    "content",
+    "postprocess_score",
+    "img_pth",
+]
+
+
+def cosmos_results_from_endpoints(result_endpoint):
+    """
+    Fetch the text and asset metadata of a finished Cosmos job from its
+    result endpoints.
+    """
+    result_endpoint_text = f"{result_endpoint}/text"
+    logger.info(f"Getting Cosmos extraction request from {result_endpoint_text}")
+    text_extractions_result = requests.get(result_endpoint_text)
+    logger.info(f"Cosmos response status code: {text_extractions_result.status_code}")
+    logger.debug(f"Cosmos result response: {text_extractions_result.text[80:]}")
+    try:
+        extraction_json = text_extractions_result.json()
+    except ValueError:
+        raise ValueError(
+            f"{text_extractions_result.text} "
+            f"with status code {text_extractions_result.status_code}"
         )
 
-        # Download the Cosmos extractions zipfile to a temporary directory
-        temp_dir = tempfile.mkdtemp()
-        zip_file_name = f"{document_id}_cosmos.zip"
-        zip_file = os.path.join(temp_dir, zip_file_name)
-        logger.info(f"Fetching Cosmos zipfile from: {result_endpoint}")
-        with open(zip_file, "wb") as writer:
-            writer.write(requests.get(result_endpoint).content)
+    # Checks status of responses, then adds their JSON content to
+    # an iterator object if they were successful.
+    assets_iterator = {}
+    for key, endpoint in COSMOS_ASSET_TYPES.items():
+        asset_endpoint = f"{result_endpoint}/extractions/{endpoint}"
+        logger.info(f"Fetching Cosmos assets from: {asset_endpoint}")
+        response = requests.get(asset_endpoint)
+        logger.info(f"{key} response status: {response.status_code}")
+        if response.status_code >= 300:
+            continue
+        else:
+            assets_iterator[key] = response.json()
 
-        presigned_response = auth_session().get(
-            f"{TDS_API}/document-asset/{document_id}/upload-url?filename={zip_file_name}"
-        )
-        upload_url = presigned_response.json().get("url")
+    return extraction_json, assets_iterator
 
-        with open(zip_file, "rb") as file:
-            asset_response = requests.put(upload_url, file)
 
-        # Extract zipfile to enable asset uploading
-        with zipfile.ZipFile(zip_file, "r") as zip_ref:
-            zip_ref.extractall(temp_dir)
+def cosmos_results_from_zip(zip_ref, result_endpoint):
+    """
+    Read the text and asset metadata of a finished Cosmos job from its result
+    zipfile, shaped like the responses of the result endpoints.
 
-        # Assets requests
-        logger.info(
-            f"Fetching Cosmos assets from:\n"
-            f"\t - {equations_endpoint}\n"
-            f"\t - {figures_endpoint}\n"
-            f"\t - {tables_endpoint}\n"
-        )
-        equations_resp = requests.get(equations_endpoint)
-        figures_resp = requests.get(figures_endpoint)
-        tables_resp = requests.get(tables_endpoint)
-        responses = {
-            "equation": equations_resp,
-            "figure": figures_resp,
-            "table": tables_resp,
-        }
+    The zipfile holds `<name>.json` with every text record and
+    `<name>_equations.json`, `<name>_figures.json` and `<name>_tables.json`.
+    """
+    members = set(zip_ref.namelist())
+    equations_member = next(
+        (name for name in members if name.endswith("_equations.json")), None
+    )
+    if equations_member is None:
+        raise ValueError("No equations JSON found in Cosmos zipfile")
+    prefix = equations_member[: -len("_equations.json")]
+
+    def normalise(record, fields):
+        record = {field: record.get(field) for field in fields}
+        if record["page_num"] is not None:
+            record["page_num"] = str(record["page_num"])
+        if record["bounding_box"] is not None:
+            record["bounding_box"] = [int(coord) for coord in record["bounding_box"]]
+        if record.get("img_pth"):
+            record["img_pth"] = f"{result_endpoint}/images/{record['img_pth'].split('/')[-1]}"
+        return record
+
+    extraction_json = [
+        normalise(record, COSMOS_TEXT_FIELDS)
+        for record in json.loads(zip_ref.read(f"{prefix}.json"))
+    ]
 
-        # Checks status of responses, then adds their JSON content to
-        # an iterator object if they were successful.
-        assets_iterator = {}
-        for key, response in responses.items():
-            logger.info(f"{key} response status: {response.status_code}")
-            if response.status_code >= 300:
-                continue
-            else:
-                assets_iterator[key] = response.json()
-
-        assets = []
-        for key, value in assets_iterator.items():
-            for record in value:
-                path = record.get("img_pth", None)
-                if path:
-                    file_name = path.split("/")[-1]  # Gets file name from json.
-
-                    file_name_path = os.path.join(temp_dir, file_name)
-                    presigned_response = auth_session().get(
-                        f"{TDS_API}/document-asset/{document_id}/upload-url?filename={file_name}"
+    assets_iterator = {}
+    for key, suffix in COSMOS_ASSET_TYPES.items():
+        member = f"{prefix}_{suffix}.json"
+        if member in members:
+            assets_iterator[key] = [
+                normalise(record, COSMOS_ASSET_FIELDS)
+                for record in json.loads(zip_ref.read(member))
+            ]
+
+    logger.info(f"Read Cosmos results from zipfile members prefixed {prefix}")
+    return extraction_json, assets_iterator
+
+
+def cosmos_collect(document_id, result_endpoint, zip_file_name=None):
+    """
+    Download the results of a finished Cosmos job and upload the result zip and
+    every extracted asset to TDS.
+    """
+    timings = {}
+    zip_file_name = zip_file_name or f"{document_id}_cosmos.zip"
+
+    # The zipfile is held in memory and only spilled to a temporary file above
+    # COSMOS_SPOOL_MAX_SIZE; the file is removed when the block exits.
+    with SpooledFile(max_size=settings.COSMOS_SPOOL_MAX_SIZE) as zip_file:
+        try:
+            started = time.perf_counter()
+            logger.info(f"Fetching Cosmos zipfile from: {result_endpoint}")
+            with requests.get(result_endpoint, stream=True) as zip_response:
+                # Error bodies must not be uploaded to TDS as the result zip
+                if zip_response.status_code != 200:
+                    raise Exception(
+                        f"Cannot download Cosmos results from {result_endpoint} (status: {zip_response.status_code}): {zip_response.text}"
                     )
-                    upload_url = presigned_response.json().get("url")
+                for chunk in zip_response.iter_content(chunk_size=1024 * 1024):
+                    zip_file.write(chunk)
+            timings["results_download"] = time.perf_counter() - started
 
-                    with open(file_name_path, "rb") as file:
-                        asset_response = requests.put(upload_url, file)
+            started = time.perf_counter()
+            presigned_response = auth_session().get(
+                f"{TDS_API}/document-asset/{document_id}/upload-url?filename={zip_file_name}"
+            )
+            upload_url = presigned_response.json().get("url")
+
+            zip_file.seek(0)
+            asset_response = http_session().put(upload_url, zip_file)
+            timings["zip_upload"] = time.perf_counter() - started
+
+            zip_file.seek(0)
+            with zipfile.ZipFile(zip_file, "r") as zip_ref:
+                zip_results = None
+                if settings.COSMOS_RESULTS_FROM_ZIP:
+                    try:
+                        zip_results = cosmos_results_from_zip(zip_ref, result_endpoint)
+                    except Exception as e:
+                        logger.warning(
+                            f"Could not read Cosmos results from zipfile, falling back to result endpoints: {e}"
+                        )
+
+                started = time.perf_counter()
+                if zip_results:
+                    extraction_json, assets_iterator = zip_results
+                else:
+                    extraction_json, assets_iterator = cosmos_results_from_endpoints(
+                        result_endpoint
+                    )
+                timings["results_metadata"] = time.perf_counter() - started
+
+                # Images are uploaded straight from the zipfile members
+                zip_members = {
+                    member.split("/")[-1]: member for member in zip_ref.namelist()
+                }
+
+                def upload_asset(asset):
+                    key, record = asset
+                    file_name = None
+                    path = record.get("img_pth", None)
+                    if path:
+                        file_name = path.split("/")[-1]  # Gets file name from json.
+
+                        presigned_response = auth_session().get(
+                            f"{TDS_API}/document-asset/{document_id}/upload-url?filename={file_name}"
+                        )
+                        upload_url = presigned_response.json().get("url")
+
+                        asset_response = http_session().put(
+                            upload_url, io.BytesIO(zip_ref.read(zip_members[file_name]))
+                        )
 
                         if asset_response.status_code >= 300:
                             raise Exception(
@@ -266,48 +539,281 @@ def cosmos_extraction(document_id, filename, downloaded_document, force_run=Fals
                                     f"(status: {asset_response.status_code}): {file_name}"
                                 )
                             )
-                else:
-                    logger.error(f"No img_pth key for {record}")
+                    else:
+                        logger.error(f"No img_pth key for {record}")
+
+                    return {
+                        "file_name": file_name,
+                        "asset_type": key,
+                        "metadata": record,
+                    }
+
+                # Presign and upload all assets concurrently, keeping their order
+                started = time.perf_counter()
+                assets = run_concurrently(
+                    upload_asset,
+                    [
+                        (key, record)
+                        for key, value in assets_iterator.items()
+                        for record in value
+                    ],
+                    max_workers=settings.COSMOS_ASSET_UPLOAD_CONCURRENCY,
+                )
+                timings["asset_upload"] = time.perf_counter() - started
+                logger.info(
+                    f"Uploaded {len(assets)} Cosmos assets in {timings['asset_upload']:.2f}s"
+                )
 
-                asset_object = {
-                    "file_name": file_name,
-                    "asset_type": key,
-                    "metadata": record,
-                }
+            logger.debug(f"Assets payload: {assets}")
 
-                assets.append(asset_object)
+            text = "\n".join([record["content"] for record in extraction_json])
 
-        logger.debug(f"Cosmos result response: {text_extractions_result.text[80:]}")
+        except ValueError as ve:
+            logger.error(f"Value Error: {ve}")
+            raise Exception(f"Extraction failure: {ve}") from None
 
-        logger.debug(f"Assets payload: {assets}")
+    return text, extraction_json, assets, zip_file_name, timings
 
-        extraction_json = text_extractions_result.json()
-        text = "\n".join([record["content"] for record in extraction_json])
 
-    except ValueError as ve:
-        logger.error(f"Value Error: {ve}")
-        raise Exception(
-            f"Extraction failure: {response.text}"
-            f"with status code {response.status_code}"
-        ) from None
+def cosmos_extraction(
+    document_id, filename, downloaded_document, force_run=False, zip_file_name=None
+):
+    started = time.perf_counter()
+    cosmos_job, status_code = cosmos_submit(
+        document_id=document_id,
+        filename=filename,
+        downloaded_document=downloaded_document,
+        force_run=force_run,
+    )
 
-    try:
-        temp_dir.cleanup()
-    except AttributeError:
-        logger.info(
-            "Temporary directory not directly cleaned, should be remove when code finishes execution."
-        )
-        logger.debug(
-            "If worker is getting large, check if temporary files are being removed."
-        )
+    submit_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    cosmos_poll(cosmos_job["status_endpoint"])
+    poll_time = time.perf_counter() - started
+
+    text, extraction_json, assets, zip_file_name, timings = cosmos_collect(
+        document_id=document_id,
+        result_endpoint=cosmos_job["result_endpoint"],
+        zip_file_name=zip_file_name,
+    )
+    timings = {"submit": submit_time, "polling": poll_time, **timings}
 
     return (
         text,
-        response.status_code,
+        status_code,
         extraction_json,
         assets,
         zip_file_name,
-        cosmos_job_id,
+        cosmos_job["job_id"],
+        timings,
+    )
+
+
+def split_pdf(downloaded_document, shard_pages):
+    """
+    Split a PDF into shards of at most `shard_pages` pages, returning a list of
+    (index of the shard's first page, shard PDF bytes) pairs in page order.
+    """
+    reader = PdfReader(io.BytesIO(downloaded_document))
+    shards = []
+    for first_page in range(0, len(reader.pages), shard_pages):
+        writer = PdfWriter()
+        for page in reader.pages[first_page : first_page + shard_pages]:
+            writer.add_page(page)
+        shard = io.BytesIO()
+        writer.write(shard)
+        shards.append((first_page, shard.getvalue()))
+    return shards
+
+
+def offset_page_numbers(records, offset):
+    """
+    Shift the `page_num` of extraction records from shard to document pages,
+    keeping the type (Cosmos reports page numbers as strings).
+    """
+    for record in records:
+        page_num = record.get("page_num")
+        if page_num is not None:
+            record["page_num"] = type(page_num)(int(page_num) + offset)
+    return records
+
+
+def sharded_pdf_extraction(document_id, filename, downloaded_document, force_run=False):
+    """
+    Extract a PDF as concurrent page-range shards and merge the results into
+    the same text, extraction records and assets as a single extraction.
+
+    Returns None when the PDF fits in one shard.
+    """
+    shards = split_pdf(downloaded_document, settings.PDF_SHARD_PAGES)
+    if len(shards) <= 1:
+        return None
+
+    logger.info(
+        f"Extracting document {document_id} as {len(shards)} shards of up to {settings.PDF_SHARD_PAGES} pages"
+    )
+    stem = filename.rsplit(".", 1)[0]
+
+    def extract_shard(shard):
+        index, (first_page, shard_document) = shard
+        shard_filename = f"{stem}_shard_{index}.pdf"
+        match settings.PDF_EXTRACTOR:
+            case ExtractionServices.SKEMA:
+                text, status_code, extraction_json = skema_extraction(
+                    document_id=document_id,
+                    filename=shard_filename,
+                    downloaded_document=shard_document,
+                )
+                assets, zip_file_name, cosmos_job_id = [], None, None
+            case ExtractionServices.COSMOS:
+                (
+                    text,
+                    status_code,
+                    extraction_json,
+                    assets,
+                    zip_file_name,
+                    cosmos_job_id,
+                    timings,
+                ) = cosmos_extraction(
+                    document_id=document_id,
+                    filename=shard_filename,
+                    downloaded_document=shard_document,
+                    force_run=force_run,
+                    zip_file_name=f"{document_id}_cosmos_{index}.zip",
+                )
+
+        offset_page_numbers(extraction_json, first_page)
+        offset_page_numbers([asset["metadata"] for asset in assets], first_page)
+        # Cosmos names records after the submitted file, which was the shard
+        for record in [*extraction_json, *(asset["metadata"] for asset in assets)]:
+            if "pdf_name" in record:
+                record["pdf_name"] = filename
+        return status_code, extraction_json, assets, zip_file_name, cosmos_job_id
+
+    results = run_concurrently(
+        extract_shard, enumerate(shards), max_workers=settings.PDF_SHARD_CONCURRENCY
+    )
+
+    # Merge in shard order so the output does not depend on completion order
+    extraction_json = [record for result in results for record in result[1]]
+    asset_order = ["equation", "figure", "table"]
+    assets = sorted(
+        (asset for result in results for asset in result[2]),
+        key=lambda asset: asset_order.index(asset["asset_type"])
+        if asset["asset_type"] in asset_order
+        else len(asset_order),
+    )
+    zip_file_names = [result[3] for result in results if result[3]]
+    cosmos_job_ids = [result[4] for result in results if result[4]]
+    text = "\n".join([record["content"] for record in extraction_json])
+
+    return (
+        text,
+        max(result[0] for result in results),
+        extraction_json,
+        assets or None,
+        zip_file_names or None,
+        ",".join(cosmos_job_ids) or None,
+    )
+
+
+def store_pdf_extraction(
+    document_id,
+    name,
+    description,
+    filename,
+    text,
+    status_code,
+    extraction_json,
+    assets=None,
+    zip_file_name=None,
+    cosmos_job_id=None,
+    timings=None,
+    cache_key=None,
+    cache_status=None,
+):
+    document_response = put_document_extraction_to_tds(
+        document_id=document_id,
+        name=name,
+        description=description,
+        filename=filename,
+        text=text,
+        assets=assets,
+        zip_file_name=zip_file_name,
+    )
+
+    if document_response.get("status") == 200:
+        response = {
+            "extraction_status_code": status_code,
+            "extraction": extraction_json,
+            "tds_status_code": document_response.get("status"),
+            "cosmos_job_id": cosmos_job_id,
+        }
+        if timings:
+            response["timings"] = {
+                phase: round(seconds, 3) for phase, seconds in timings.items()
+            }
+        if cache_status:
+            response["cache"] = cache_status
+    else:
+        raise Exception(
+            f"PUT extraction metadata to TDS failed with status"
+            f"{document_response.get('status')} please check TDS api logs."
+        ) from None
+
+    cache = get_cache("pdf_extraction")
+    if cache and cache_key:
+        if isinstance(zip_file_name, str):
+            zip_file_name = [zip_file_name]
+        cache.set(
+            cache_key,
+            {
+                "document_id": document_id,
+                "text": text,
+                "status_code": status_code,
+                "extraction_json": extraction_json,
+                "assets": assets,
+                "zip_file_names": zip_file_name or [],
+                "cosmos_job_id": cosmos_job_id,
+            },
+        )
+
+    return response
+
+
+def cached_pdf_extraction(document_id, cached):
+    """
+    Reuse a cached extraction of the same PDF made for another document by
+    copying its Cosmos zipfiles and assets over in TDS.
+    """
+    source_document_id = cached["document_id"]
+
+    # Zipfiles are named after their document, assets after their content
+    copies = [
+        (zip_name, zip_name.replace(source_document_id, document_id, 1))
+        for zip_name in cached["zip_file_names"]
+    ]
+    copies.extend(
+        (asset["file_name"], asset["file_name"])
+        for asset in cached["assets"] or []
+        if asset.get("file_name")
+    )
+    if source_document_id != document_id:
+        run_concurrently(
+            lambda names: copy_document_file(source_document_id, document_id, *names),
+            copies,
+            max_workers=settings.COSMOS_ASSET_UPLOAD_CONCURRENCY,
+        )
+
+    zip_file_names = [target for _, target in copies[: len(cached["zip_file_names"])]]
+    return (
+        cached["text"],
+        cached["status_code"],
+        cached["extraction_json"],
+        cached["assets"],
+        zip_file_names or None,
+        cached["cosmos_job_id"],
     )
 
 
@@ -316,12 +822,68 @@ def pdf_extraction(*args, **kwargs):
     document_id = kwargs.get("document_id")
     force_run = kwargs.get("force_run")
 
-    document_json, downloaded_document = get_document_from_tds(
-        document_id=document_id
-    )  # Assumes  downloaded document is PDF, doesn't type check
+    document_json = get_document_metadata_from_tds(document_id=document_id)
     filename = document_json.get("file_names")[0]
+    zip_file_name = None
+    cosmos_job_id = None
+    timings = None
+    extracted = None
+    cache_status = None
+
+    # A previous extraction already stored the text and assets on this document
+    if not force_run and document_json.get("text") and document_json.get("assets"):
+        logger.info(f"Document {document_id} already has text and assets, skipping extraction")
+        return {
+            "extraction_status_code": None,
+            "extraction": None,
+            "tds_status_code": None,
+            "cosmos_job_id": None,
+            "cache": "document",
+        }
+
+    # Assumes downloaded document is PDF, doesn't type check
+    downloaded_document = get_document_content_from_tds(document_id, filename)
+
+    cache = get_cache("pdf_extraction")
+    cache_key = None
+    if cache:
+        cache_key = content_hash(downloaded_document, settings.PDF_EXTRACTOR.value)
+        cache_status = "miss"
+        cached = None if force_run else cache.get(cache_key)
+        if cached:
+            try:
+                extracted = cached_pdf_extraction(document_id, cached)
+                cache_status = "hit"
+            except Exception as e:
+                logger.warning(
+                    f"Could not reuse cached extraction for document {document_id}, extracting again: {e}"
+                )
+
+    async_cosmos = (
+        settings.PDF_EXTRACTOR == ExtractionServices.COSMOS
+        and settings.COSMOS_ASYNC_POLLING
+    )
+    if not extracted and settings.PDF_SHARD_PAGES > 0 and not async_cosmos:
+        started = time.perf_counter()
+        extracted = sharded_pdf_extraction(
+            document_id=document_id,
+            filename=filename,
+            downloaded_document=downloaded_document,
+            force_run=force_run,
+        )
+        if extracted:
+            timings = {"sharded_extraction": time.perf_counter() - started}
 
     match settings.PDF_EXTRACTOR:
+        case _ if extracted:
+            (
+                text,
+                status_code,
+                extraction_json,
+                assets,
+                zip_file_name,
+                cosmos_job_id,
+            ) = extracted
         case ExtractionServices.SKEMA:
             text, status_code, extraction_json = skema_extraction(
                 document_id=document_id,
@@ -329,6 +891,39 @@ def pdf_extraction(*args, **kwargs):
                 downloaded_document=downloaded_document,
             )
             assets = None
+        case ExtractionServices.COSMOS if settings.COSMOS_ASYNC_POLLING:
+            # Hand the Cosmos job to the poller instead of holding this worker,
+            # `pdf_extraction_continuation` finishes the job once Cosmos is done.
+            cosmos_job, status_code = cosmos_submit(
+                document_id=document_id,
+                filename=filename,
+                downloaded_document=downloaded_document,
+                force_run=force_run,
+            )
+            continuation_job_id = cosmos_poller.register(
+                connection=get_current_connection(),
+                status_endpoint=cosmos_job["status_endpoint"],
+                continuation_kwargs={
+                    "document_id": document_id,
+                    "name": document_json.get("name", None),
+                    "description": document_json.get("description", None),
+                    "filename": filename,
+                    "status_code": status_code,
+                    "cosmos_job_id": cosmos_job["job_id"],
+                    "result_endpoint": cosmos_job["result_endpoint"],
+                    "cache_key": cache_key,
+                },
+            )
+            logger.info(
+                f"Cosmos job {cosmos_job['job_id']} handed to poller, continuing in job {continuation_job_id}"
+            )
+            return {
+                "extraction_status_code": status_code,
+                "extraction": None,
+                "tds_status_code": None,
+                "cosmos_job_id": cosmos_job["job_id"],
+                "continuation_job_id": continuation_job_id,
+            }
         case ExtractionServices.COSMOS:
             (
                 text,
@@ -337,6 +932,7 @@ def pdf_extraction(*args, **kwargs):
                 assets,
                 zip_file_name,
                 cosmos_job_id,
+                timings,
             ) = cosmos_extraction(
                 document_id=document_id,
                 force_run=force_run,
@@ -344,30 +940,186 @@ def pdf_extraction(*args, **kwargs):
                 downloaded_document=downloaded_document,
             )
 
-    document_response = put_document_extraction_to_tds(
+    return store_pdf_extraction(
         document_id=document_id,
         name=document_json.get("name", None),
         description=document_json.get("description", None),
         filename=filename,
         text=text,
+        status_code=status_code,
+        extraction_json=extraction_json,
         assets=assets,
         zip_file_name=zip_file_name,
+        cosmos_job_id=cosmos_job_id,
+        timings=timings,
+        cache_key=cache_key if cache_status == "miss" else None,
+        cache_status=cache_status,
     )
 
-    if document_response.get("status") == 200:
-        response = {
-            "extraction_status_code": status_code,
-            "extraction": extraction_json,
-            "tds_status_code": document_response.get("status"),
-            "cosmos_job_id": cosmos_job_id,
-        }
-    else:
+
+def pdf_extraction_continuation(*args, **kwargs):
+    """
+    Second half of an asynchronously polled Cosmos `pdf_extraction`, enqueued
+    by `worker.cosmos_poller` once Cosmos reports the job as done.
+    """
+    document_id = kwargs.get("document_id")
+    cosmos_job_id = kwargs.get("cosmos_job_id")
+    cosmos_error = kwargs.get("cosmos_error")
+
+    if cosmos_error:
         raise Exception(
-            f"PUT extraction metadata to TDS failed with status"
-            f"{document_response.get('status')} please check TDS api logs."
-        ) from None
+            f"An error occurred when processing in Cosmos job {cosmos_job_id}: {cosmos_error}"
+        )
 
-    return response
+    text, extraction_json, assets, zip_file_name, timings = cosmos_collect(
+        document_id=document_id, result_endpoint=kwargs.get("result_endpoint")
+    )
+
+    return store_pdf_extraction(
+        document_id=document_id,
+        name=kwargs.get("name"),
+        description=kwargs.get("description"),
+        filename=kwargs.get("filename"),
+        text=text,
+        status_code=kwargs.get("status_code"),
+        extraction_json=extraction_json,
+        assets=assets,
+        zip_file_name=zip_file_name,
+        cosmos_job_id=cosmos_job_id,
+        timings=timings,
+        cache_key=kwargs.get("cache_key"),
+    )
+
+
+def skema_annotation(document_id, text):
+    """
+    Send text to the SKEMA integrated text reading service.
+
+    Returns the response, its JSON (None on failure) and the latency in seconds.
+    """
+    unified_text_reading_url = f"{UNIFIED_API}/text-reading/integrated-text-extractions?annotate_skema=True&annotate_mit=False"
+    payload = {"texts": [text]}
+
+    started = time.perf_counter()
+    skema_response = None
+    skema_extraction_json = None
+    try:
+        logger.info(
+            f"Sending document to SKEMA service with document id {document_id} at {unified_text_reading_url}"
+        )
+        batcher = get_skema_batcher(unified_text_reading_url)
+        if batcher:
+            skema_response, skema_extraction_json = batcher.submit(text)
+        else:
+            skema_response = requests.post(
+                unified_text_reading_url,
+                json=payload,
+                timeout=settings.SKEMA_ANNOTATION_TIMEOUT,
+            )
+            skema_extraction_json = skema_response.json()
+        logger.info(
+            f"Response received from SKEMA service with status code: {skema_response.status_code}"
+        )
+        logger.debug(f"SKEMA variable response object: {skema_response.text}")
+
+    except Exception as e:
+        logger.error(f"SKEMA variable extraction for document {document_id} failed: {e}")
+
+    return skema_response, skema_extraction_json, time.perf_counter() - started
+
+
+def mit_annotation(document_id, text, kg_domain):
+    """
+    Send text to the MIT annotation service.
+
+    Returns the response, its JSON (None on failure) and the latency in seconds.
+    """
+    mit_text_reading_url = f"{MIT_API}/annotation/upload_file_extract"
+    files = {
+        "file": text.encode(),
+    }
+    params = {"gpt_key": OPENAI_API_KEY, "kg_domain": kg_domain}
+
+    started = time.perf_counter()
+    mit_response = None
+    mit_extraction_json = None
+    try:
+        logger.info(
+            f"Sending document to MIT service with document id {document_id} at {mit_text_reading_url}"
+        )
+        mit_response = requests.post(
+            mit_text_reading_url,
+            params=params,
+            files=files,
+            timeout=settings.MIT_ANNOTATION_TIMEOUT,
+        )
+        logger.info(
+            f"Response received from MIT service with status code: {mit_response.status_code}"
+        )
+        mit_extraction_json = mit_response.json()
+        logger.debug(f"MIT variable response object: {mit_response.text}")
+
+    except Exception as e:
+        logger.error(f"MIT variable extraction for document {document_id} failed: {e}")
+
+    return mit_response, mit_extraction_json, time.perf_counter() - started
+
+
+def annotate_text(document_id, text, annotate_skema, annotate_mit, kg_domain):
+    """
+    Run the requested annotators side by side since both are slow.
+
+    Returns the status code, JSON and latency of SKEMA then MIT, with None for
+    an annotator that was not requested, and whether every requested annotator
+    answered 200 for every chunk.
+    """
+    annotators = []
+    if annotate_skema:
+        annotators.append(
+            lambda: annotate_in_chunks(
+                lambda chunk: skema_annotation(document_id, chunk),
+                text,
+                lambda extraction_json: extraction_json["outputs"][0]["data"],
+            )
+        )
+    if annotate_mit:
+        annotators.append(
+            lambda: annotate_in_chunks(
+                lambda chunk: mit_annotation(document_id, chunk, kg_domain),
+                text,
+                lambda extraction_json: extraction_json,
+            )
+        )
+    annotations = run_concurrently(lambda annotate: annotate(), annotators, max_workers=2)
+
+    skema_response, skema_extraction_json, skema_latency, skema_failed = (
+        annotations.pop(0) if annotate_skema else (None, None, None, 0)
+    )
+    mit_response, mit_extraction_json, mit_latency, mit_failed = (
+        annotations.pop(0) if annotate_mit else (None, None, None, 0)
+    )
+
+    complete = all(
+        response is not None
+        and response.status_code == 200
+        and extraction_json is not None
+        and not failed
+        for requested, response, extraction_json, failed in (
+            (annotate_skema, skema_response, skema_extraction_json, skema_failed),
+            (annotate_mit, mit_response, mit_extraction_json, mit_failed),
+        )
+        if requested
+    )
+
+    return (
+        skema_response.status_code if skema_response is not None else None,
+        skema_extraction_json,
+        skema_latency,
+        mit_response.status_code if mit_response is not None else None,
+        mit_extraction_json,
+        mit_latency,
+        complete,
+    )
 
 
 def variable_extractions(*args, **kwargs):
@@ -378,8 +1130,9 @@ def variable_extractions(*args, **kwargs):
     name = kwargs.get("name")
     description = kwargs.get("description")
     kg_domain = kwargs.get("domain", "epi")
+    force_run = kwargs.get("force_run", False)
 
-    document_json, downloaded_document = get_document_from_tds(document_id=document_id)
+    document_json = get_document_metadata_from_tds(document_id=document_id)
 
     text = document_json.get("text", None)
     if not text:
@@ -387,48 +1140,49 @@ def variable_extractions(*args, **kwargs):
             "No text found in paper document, please ensure to submit to /pdf_extraction endpoint."
         )
 
-    # Send document to SKEMA
-    if annotate_skema:
-        unified_text_reading_url = f"{UNIFIED_API}/text-reading/integrated-text-extractions?annotate_skema={annotate_skema}&annotate_mit=False"
-        payload = {"texts": [text]}
-
-        try:
-            logger.info(
-                f"Sending document to SKEMA service with document id {document_id} at {unified_text_reading_url}"
-            )
-            skema_response = requests.post(unified_text_reading_url, json=payload)
-            logger.info(
-                f"Response received from SKEMA service with status code: {skema_response.status_code}"
-            )
-            skema_extraction_json = skema_response.json()
-            logger.debug(f"SKEMA variable response object: {skema_response.text}")
-
-        except Exception as e:
-            logger.error(f"SKEMA variable extraction for document {document_id} failed.")
-
-    # Send document to MIT
-    if annotate_mit:
-        mit_text_reading_url = f"{MIT_API}/annotation/upload_file_extract"
-        files = {
-            "file": text.encode(),
-        }
-        params = {"gpt_key": OPENAI_API_KEY, "kg_domain": kg_domain}
+    # Annotator outputs only depend on the text, the options and the services
+    cache = get_cache("variable_extractions")
+    cache_key = None
+    cached = None
+    if cache:
+        cache_key = content_hash(
+            text,
+            bool(annotate_skema),
+            bool(annotate_mit),
+            kg_domain,
+            UNIFIED_API,
+            MIT_API,
+            settings.ANNOTATION_VERSION,
+            settings.ANNOTATION_CHUNK_CHARS,
+        )
+        cached = None if force_run else cache.get(cache_key)
 
-        try:
-            logger.info(
-                f"Sending document to MIT service with document id {document_id} at {mit_text_reading_url}"
-            )
-            mit_response = requests.post(mit_text_reading_url, params=params, files=files)
-            logger.info(
-                f"Response received from MIT service with status code: {mit_response.status_code}"
+    if cached:
+        skema_status_code, skema_extraction_json = cached["skema"]
+        mit_status_code, mit_extraction_json = cached["mit"]
+        skema_latency = mit_latency = None
+    else:
+        (
+            skema_status_code,
+            skema_extraction_json,
+            skema_latency,
+            mit_status_code,
+            mit_extraction_json,
+            mit_latency,
+            complete,
+        ) = annotate_text(document_id, text, annotate_skema, annotate_mit, kg_domain)
+
+        # Failed annotations are worth retrying, so only cache complete runs
+        if cache and complete:
+            cache.set(
+                cache_key,
+                {
+                    "skema": [skema_status_code, skema_extraction_json],
+                    "mit": [mit_status_code, mit_extraction_json],
+                },
             )
-            mit_extraction_json = mit_response.json()
-            logger.debug(f"MIT variable response object: {mit_response.text}")
-
-        except Exception as e:
-            logger.error(f"MIT variable extraction for document {document_id} failed.")
 
-    # TODO: implement merging code here that generates
+    # Merge the collections from both annotators
     collections = list()
 
     try:
@@ -449,6 +1203,15 @@ def variable_extractions(*args, **kwargs):
         logger.info("Falling back on single variable extraction since one system failed")
         attributes = list(it.chain.from_iterable(c.attributes for c in collections))
         variables = AttributeCollection(attributes=attributes)
+    elif settings.VARIABLE_MERGE == "local":
+        started = time.perf_counter()
+        attributes = merge_variable_attributes(
+            skema_extraction_json["outputs"][0]["data"], mit_extraction_json
+        )
+        variables = AttributeCollection.from_json({"attributes": attributes})
+        logger.info(
+            f"Merged variables locally in {time.perf_counter() - started:.3f} seconds"
+        )
     else:
         # Merge both with some de de-duplications
         params = {"gpt_key": OPENAI_API_KEY}
@@ -472,17 +1235,10 @@ def variable_extractions(*args, **kwargs):
             attributes = list(it.chain.from_iterable(c.attributes for c in collections))
             variables = AttributeCollection(attributes=attributes)
 
-    if len(document_json.get("file_names")) > 1:
-        zip_file_name = document_json.get("file_names")[1]
-    else:
-        zip_file_name = None
-
     extraction_json = json.loads(variables.json())
 
-    if len(document_json.get("file_names")) > 1:
-        zip_file_name = document_json.get("file_names")[1]
-    else:
-        zip_file_name = None
+    # Cosmos zipfiles (one per shard for sharded extractions) follow the PDF
+    zip_file_name = document_json.get("file_names")[1:] or None
 
     document_response = put_document_extraction_to_tds(
         document_id=document_id,
@@ -505,15 +1261,14 @@ def variable_extractions(*args, **kwargs):
             "tds_status_code": document_response.get("status"),
             "error": None,
         }
-        if annotate_skema:
-            response["skema_extraction_status_code"] = skema_response.status_code
-        else:
-            response["skema_extraction_status_code"] = None
-
-        if annotate_mit:
-            response["mit_extraction_status_code"] = mit_response.status_code
-        else:
-            response["mit_extraction_status_code"] = None
+        response["skema_extraction_status_code"] = skema_status_code
+        response["mit_extraction_status_code"] = mit_status_code
+        if cache:
+            response["cache"] = "hit" if cached else "miss"
+        response["annotation_latencies"] = {
+            "skema": round(skema_latency, 3) if skema_latency is not None else None,
+            "mit": round(mit_latency, 3) if mit_latency is not None else None,
+        }
     else:
         raise Exception(
             f"PUT extraction metadata to TDS failed with status"
@@ -528,9 +1283,7 @@ def data_card(*args, **kwargs):
     document_id = kwargs.get("document_id")
 
     if document_id:
-        document_json, downloaded_document = get_document_from_tds(
-            document_id
-        )
+        document_json = get_document_metadata_from_tds(document_id)
         doc_file = document_json.get(
             "text", "There is no documentation for this dataset"
         ).encode()
@@ -539,21 +1292,38 @@ def data_card(*args, **kwargs):
 
     logger.debug(f"document file: {doc_file}")
 
-    dataset_response, dataset_dataframe, dataset_csv_string = get_dataset_from_tds(
-        dataset_id
-    )
+    dataset_response, dataset_files = download_dataset_from_tds(dataset_id)
     dataset_json = dataset_response.json()
 
     params = {"gpt_key": OPENAI_API_KEY}
 
-    files = {
-        "csv_file": ("csv_file", dataset_csv_string.encode()),
-        "doc_file": ("doc_file", doc_file),
-    }
-
     url = f"{MIT_API}/cards/get_data_card"
     logger.info(f"Sending dataset {dataset_id} and document {document_id} to MIT service at {url}")
-    resp = requests.post(url, params=params, files=files)
+    try:
+        # Parquet and Arrow files are profiled straight from their record batches
+        profile = profile_frames(
+            it.chain.from_iterable(
+                iter_dataset_frames(file_format, dataset_file)
+                for file_format, dataset_file in dataset_files
+            )
+        )
+
+        # MIT gets a bounded sample and the local statistics instead of every row
+        if settings.DATA_CARD_SAMPLE_ROWS > 0:
+            csv_upload = profile.sample_csv(settings.DATA_CARD_SAMPLE_ROWS).encode()
+            doc_file = doc_file + b"\n\n" + profile.summary().encode()
+        else:
+            csv_upload = combine_dataset_files(dataset_files)
+            dataset_files.append(("csv", csv_upload))
+
+        files = {
+            "csv_file": ("csv_file", csv_upload),
+            "doc_file": ("doc_file", doc_file),
+        }
+        resp = requests.post(url, params=params, files=files)
+    finally:
+        for _, dataset_file in dataset_files:
+            dataset_file.close()
     if resp.status_code != 200:
         raise Exception(f"Failed response from MIT: {resp.status_code}, {resp.text}")
 
@@ -566,7 +1336,7 @@ def data_card(*args, **kwargs):
     sys.stdout.flush()
 
     columns = []
-    for c in dataset_dataframe.columns:
+    for c, column_stats in profile.columns.items():
         annotation = data_profiling_result.get(c, {})
 
         # parse groundings
@@ -578,9 +1348,12 @@ def data_card(*args, **kwargs):
         annotation.pop("dkg_groundings")
         annotation["groundings"] = groundings
 
+        # MIT only saw a sample, the local profile covers every row
+        annotation["column_stats"] = column_stats
+
         col = {
             "name": c,
-            "data_type": "float",
+            "data_type": column_stats["type"],
             "description": annotation.get("description", "").strip(),
             "annotations": [],
             "metadata": annotation,
@@ -632,7 +1405,7 @@ def model_card(*args, **kwargs):
     logger.debug(f"Code file head (250 chars): {code_file[:250]}")
 
     if paper_document_id:
-        paper_document_json, paper_downloaded_document = get_document_from_tds(
+        paper_document_json = get_document_metadata_from_tds(
             document_id=paper_document_id
         )
 
@@ -644,7 +1417,7 @@ def model_card(*args, **kwargs):
         text_file = "There is no documentation for this model"
 
     # TODO: Remove when no character limit exists for MIT
-    text_file = text_file[:9000]
+    _, text_file = chunk_text(text_file, 9000)[0]
 
     amr = get_model_from_tds(model_id).json()
 
@@ -667,23 +1440,25 @@ def model_card(*args, **kwargs):
             card = resp.json()
             sys.stdout.flush()
 
-            amr["description"] = card.get("DESCRIPTION")
-            if not amr.get("metadata", None):
-                amr["metadata"] = {"card": card}
-            else:
-                amr["metadata"]["card"] = card
+            updated_amr = dict(
+                amr,
+                description=card.get("DESCRIPTION"),
+                metadata=dict(amr.get("metadata") or {}, card=card),
+            )
 
-            tds_resp = auth_session().put(f"{TDS_API}/models/{model_id}", json=amr)
-            if tds_resp.status_code == 200:
-                logger.info(f"Updated model {model_id} in TDS: {tds_resp.status_code}")
+            status_code = update_model_in_tds(
+                model_id, amr, updated_amr, connection=get_current_connection()
+            )
+            if status_code == 200:
+                logger.info(f"Updated model {model_id} in TDS: {status_code}")
                 return {
-                    "status": tds_resp.status_code,
+                    "status": status_code,
                     "message": "Model card generated and updated in TDS",
                     "card": card,
                 }
             else:
                 raise Exception(
-                    f"Error when updating model {model_id} in TDS: {tds_resp.status_code}"
+                    f"Error when updating model {model_id} in TDS: {status_code}"
                 )
         except Exception as e:
             raise Exception(f"Failed to generate model card for {model_id}: {e}")
@@ -698,7 +1473,7 @@ def link_amr(*args, **kwargs):
     document_id = kwargs.get("document_id")
     model_id = kwargs.get("model_id")
 
-    document_json, downloaded_document = get_document_from_tds(document_id=document_id)
+    document_json = get_document_metadata_from_tds(document_id=document_id)
 
     extractions = document_json.get("metadata", {})
 
@@ -739,10 +1514,14 @@ def link_amr(*args, **kwargs):
 
     if response.status_code == 200:
         enriched_amr = response.json()
-        enriched_amr['metadata']['card'] = model_card
+        # A None card would erase one written concurrently by model_card
+        if model_card is not None:
+            enriched_amr.setdefault("metadata", {})["card"] = model_card
 
-        model_response = auth_session().put(tds_model_url, json=enriched_amr)
-        if model_response.status_code != 200:
+        status_code = update_model_in_tds(
+            model_id, model_amr, enriched_amr, connection=get_current_connection()
+        )
+        if status_code != 200:
             raise Exception(
                 f"Cannot update model {model_id} in TDS with payload:\n\n {enriched_amr}"
             )
@@ -763,7 +1542,7 @@ def link_amr(*args, **kwargs):
             logger.error(f"Failed to set provenance between model {model_id} and document {document_id}: {e}")
 
         return {
-            "status": model_response.status_code,
+            "status": status_code,
             "amr": model_amr,
             "message": "Model enriched and updated in TDS",
         }
@@ -774,30 +1553,104 @@ def link_amr(*args, **kwargs):
 
 
 # 60e539e4-6969-4369-a358-c601a3a583da
-def code_to_amr(*args, **kwargs):
-    code_id = kwargs.get("code_id")
-    name = kwargs.get("name")
-    model_id = kwargs.get("model_id")
-    description = kwargs.get("description")
-    llm_assisted = kwargs.get("llm_assisted", True)
-    dynamics_only = kwargs.get("dynamics_only", False)
+def normalise_code(code_content):
+    """
+    Code as hashed for the code to AMR cache: line endings and trailing
+    whitespace don't change the extracted model.
+    """
+    if isinstance(code_content, list):
+        return [normalise_code(block) for block in code_content]
+    if isinstance(code_content, bytes):
+        code_content = code_content.decode("utf-8", errors="replace")
+    return "\n".join(line.rstrip() for line in code_content.splitlines()).strip()
+
+
+def filter_code_files(files):
+    """
+    Pick the files of a code asset worth downloading for SKEMA, by path,
+    extension and the language TDS records for them (files without one are
+    kept).
+
+    Returns the kept files and a list of the skipped ones with the reason.
+    """
+    def setting_list(value):
+        return {item.strip() for item in value.split(",") if item.strip()}
+
+    extensions = {e.lower() for e in setting_list(settings.CODE_ZIP_EXTENSIONS)}
+    excluded_extensions = {
+        e.lower() for e in setting_list(settings.CODE_ZIP_EXCLUDE_EXTENSIONS)
+    }
+    excluded_dirs = setting_list(settings.CODE_ZIP_EXCLUDE_DIRS)
+    languages = {l.lower() for l in setting_list(settings.CODE_ZIP_LANGUAGES)}
+
+    kept = {}
+    skipped = []
+    for code_name, file_details in files.items():
+        extension = os.path.splitext(code_name)[1].lower()
+        language = ((file_details or {}).get("language") or "").lower()
+        if excluded_dirs.intersection(code_name.split("/")[:-1]):
+            skipped.append({"name": code_name, "reason": "excluded directory"})
+        elif extension in excluded_extensions or (
+            extensions and extension not in extensions
+        ):
+            skipped.append({"name": code_name, "reason": "excluded extension"})
+        elif languages and language and language not in languages:
+            skipped.append({"name": code_name, "reason": "excluded language"})
+        else:
+            kept[code_name] = file_details
+    return kept, skipped
+
+
+def select_code_files(downloaded_code_object, skipped=()):
+    """
+    Pick the downloaded files worth zipping for SKEMA: files within
+    `CODE_ZIP_MAX_FILE_BYTES` and the `CODE_ZIP_MAX_TOTAL_BYTES` budget, of
+    which only the survivors are checked to be UTF-8 text.
+
+    Returns the selected files and a manifest of the included and skipped
+    files, starting with the `skipped` ones of `filter_code_files`.
+    """
+    selected = {}
+    manifest = {"included": [], "skipped": list(skipped), "bytes": 0}
+    for code_name, code_content in downloaded_code_object.items():
+        if len(code_content) > settings.CODE_ZIP_MAX_FILE_BYTES:
+            reason = "file too large"
+        elif manifest["bytes"] + len(code_content) > settings.CODE_ZIP_MAX_TOTAL_BYTES:
+            reason = "over total budget"
+        elif not is_utf8(code_content):
+            reason = "not utf-8 text"
+        else:
+            reason = None
+
+        if reason:
+            manifest["skipped"].append({"name": code_name, "reason": reason})
+            continue
+        selected[code_name] = code_content
+        manifest["included"].append(code_name)
+        manifest["bytes"] += len(code_content)
 
-    code_json, downloaded_code_object, dynamics_off_flag = get_code_from_tds(
-        code_id, code=True, dynamics_only=dynamics_only
+    logger.info(
+        f"Zipping {len(manifest['included'])} code files ({manifest['bytes']} bytes), "
+        f"skipped {len(manifest['skipped'])}"
     )
+    return selected, manifest
 
-    # Checks the return flag from the dynamics retrieval process
-    if dynamics_off_flag:
-        dynamics_only = False
 
-    # default to using LLM assisted extraction
-    code_amr_workflow_url = f"{UNIFIED_API}/workflows/code/llm-assisted-codebase-to-pn-amr"
-    if not llm_assisted:
-        code_amr_workflow_url = f"{UNIFIED_API}/workflows/code/codebase-to-pn-amr"
-    if dynamics_only:
-        code_amr_workflow_url = f"{UNIFIED_API}/workflows/code/snippets-to-pn-amr"
+def is_utf8(content):
+    try:
+        content.decode("utf-8")
+    except UnicodeDecodeError:
+        return False
+    return True
+
 
+def code_amr_request(code_id, code_amr_workflow_url, downloaded_code_object, dynamics_only):
+    """
+    Send code to a SKEMA code to AMR workflow.
 
+    Returns the status code, the AMR (None if the response could not be
+    parsed) and the response text.
+    """
     if dynamics_only:
         blobs = []
         names = []
@@ -811,15 +1664,15 @@ def code_to_amr(*args, **kwargs):
 
     else:
         zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zipf:
+        with zipfile.ZipFile(
+            zip_buffer,
+            "w",
+            zipfile.ZIP_DEFLATED,
+            compresslevel=settings.CODE_ZIP_COMPRESSION_LEVEL,
+        ) as zipf:
             # Use io and zipfile to write the code_content to a zipfile in memory
             for code_name, code_content in downloaded_code_object.items():
-                try:
-                    zipf.writestr(code_name, code_content.decode("utf-8"))
-                except UnicodeDecodeError as e:
-                    logging.error(
-                        f"File unable to be decoded with utf-8 and written to zip, skipping. {e}"
-                    )
+                zipf.writestr(code_name, code_content)
 
         zip_buffer.seek(0)
         request_payload = zip_buffer
@@ -843,8 +1696,7 @@ def code_to_amr(*args, **kwargs):
         f"Response received from backend knowledge service with status code: {amr_response.status_code}"
     )
 
-    amr_json = amr_response
-
+    amr_json = None
     try:
         amr_json = amr_response.json()
         logger.debug(f"TA 1 response object: {amr_json}")
@@ -853,7 +1705,77 @@ def code_to_amr(*args, **kwargs):
             f"Failed to parse response from backend knowledge service:\n{amr_response.text}"
         )
 
-    if amr_response.status_code == 200 and amr_json:
+    return amr_response.status_code, amr_json, amr_response.text
+
+
+def code_to_amr(*args, **kwargs):
+    code_id = kwargs.get("code_id")
+    name = kwargs.get("name")
+    model_id = kwargs.get("model_id")
+    description = kwargs.get("description")
+    llm_assisted = kwargs.get("llm_assisted", True)
+    dynamics_only = kwargs.get("dynamics_only", False)
+
+    # Files SKEMA won't use are filtered out before they are downloaded
+    filtered = []
+
+    def filter_files(files):
+        kept, skipped = filter_code_files(files)
+        filtered.extend(skipped)
+        return kept
+
+    (
+        code_json,
+        downloaded_code_object,
+        dynamics_off_flag,
+        download_stats,
+    ) = get_code_from_tds(
+        code_id, code=True, dynamics_only=dynamics_only, file_filter=filter_files
+    )
+
+    # Checks the return flag from the dynamics retrieval process
+    if dynamics_off_flag:
+        dynamics_only = False
+
+    # default to using LLM assisted extraction
+    code_amr_workflow_url = f"{UNIFIED_API}/workflows/code/llm-assisted-codebase-to-pn-amr"
+    if not llm_assisted:
+        code_amr_workflow_url = f"{UNIFIED_API}/workflows/code/codebase-to-pn-amr"
+    if dynamics_only:
+        code_amr_workflow_url = f"{UNIFIED_API}/workflows/code/snippets-to-pn-amr"
+
+    # Only source files within the size budget are zipped for SKEMA
+    zip_manifest = None
+    if not dynamics_only:
+        downloaded_code_object, zip_manifest = select_code_files(
+            downloaded_code_object, filtered
+        )
+
+    # Identical code sent to the same workflow yields the same AMR
+    cache = get_cache("code_to_amr")
+    cache_key = None
+    cached = None
+    if cache:
+        cache_key = content_hash(
+            code_amr_workflow_url,
+            *(
+                part
+                for code_name, code_content in sorted(downloaded_code_object.items())
+                for part in (code_name, normalise_code(code_content))
+            ),
+        )
+        cached = cache.get(cache_key)
+
+    if cached:
+        status_code, amr_json, response_text = 200, cached, None
+    else:
+        status_code, amr_json, response_text = code_amr_request(
+            code_id, code_amr_workflow_url, downloaded_code_object, dynamics_only
+        )
+        if cache and status_code == 200 and amr_json:
+            cache.set(cache_key, amr_json)
+
+    if status_code == 200 and amr_json:
         metadata = amr_json.get("metadata", {})
         metadata["code_id"] = code_id
         amr_json["metadata"] = metadata
@@ -880,14 +1802,19 @@ def code_to_amr(*args, **kwargs):
             logger.error(f"Failed to store provenance tying model to code: {e}")
 
         response = {
-            "status_code": amr_response.status_code,
+            "status_code": status_code,
             "amr": amr_json,
             "tds_model_id": tds_responses.get("model_id"),
             "tds_configuration_id": tds_responses.get("configuration_id"),
+            "tds_model_unchanged": tds_responses.get("unchanged"),
+            "code_download": download_stats,
+            "zip_manifest": zip_manifest,
             "error": None,
         }
+        if cache:
+            response["cache"] = "hit" if cached else "miss"
 
         return response
     else:
-        logger.error(f"Content: {amr_response.content}")
-        raise Exception(f"Code extraction failure: {amr_response.text}")
+        logger.error(f"Content: {response_text}")
+        raise Exception(f"Code extraction failure: {response_text}")
@@ -0,0 +1,73 @@
+"""
+rq worker that imports the operations and their heavy dependencies once, in
+the parent process, so every forked work-horse inherits warm modules through
+copy-on-write instead of importing them again for each job.
+
+Usage:
+    rq worker --worker-class worker.preload.PreloadWorker --url redis://... high default low
+"""
+
+import gc
+import logging
+import time
+
+from rq import Worker
+
+from lib.settings import settings
+
+_preload_started = time.perf_counter()
+
+import pandas  # noqa: E402,F401
+import requests  # noqa: E402,F401
+import askem_extractions.data_model  # noqa: E402,F401
+
+import worker.utils  # noqa: E402,F401
+import worker.operations  # noqa: E402,F401
+
+PRELOAD_SECONDS = time.perf_counter() - _preload_started
+
+# Move everything imported so far into the permanent generation, so garbage
+# collection in the work-horses never writes to (and so copies) those pages.
+gc.freeze()
+
+LOG_LEVEL = settings.LOG_LEVEL.upper()
+
+numeric_level = getattr(logging, LOG_LEVEL, None)
+if not isinstance(numeric_level, int):
+    raise ValueError(f"Invalid log level: {LOG_LEVEL}")
+
+logger = logging.getLogger(__name__)
+logger.setLevel(numeric_level)
+handler = logging.StreamHandler()
+formatter = logging.Formatter(
+    "%(asctime)s - %(name)s - %(levelname)s - [%(lineno)d] - %(message)s"
+)
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+logger.info(f"Preloaded worker operations in {PRELOAD_SECONDS:.3f}s")
+
+
+class PreloadWorker(Worker):
+    """
+    Forking worker which records, per job, the time between the fork and the
+    job function being ready to run in `job.meta["fork_overhead_seconds"]`.
+    """
+
+    def fork_work_horse(self, job, queue):
+        self._fork_started = time.perf_counter()
+        super().fork_work_horse(job, queue)
+
+    def main_work_horse(self, job, queue):
+        try:
+            # Resolving the function is where a cold work-horse pays for imports
+            job.func
+            overhead = time.perf_counter() - self._fork_started
+            job.meta["fork_overhead_seconds"] = round(overhead, 4)
+            job.save_meta()
+            logger.info(f"Fork overhead for job {job.id}: {overhead:.4f}s")
+        except Exception as e:
+            # Let perform_job surface any real problem with the job
+            logger.warning(f"Could not measure fork overhead for job {job.id}: {e}")
+
+        super().main_work_horse(job, queue)
@@ -0,0 +1,130 @@
+"""
+Concurrent I/O worker mode.
+
+Every operation spends most of its wall time blocked on HTTP, so instead of one
+forked work-horse per job this runs many rq workers as threads of a single
+process. Each thread is a regular rq worker bound to one queue, so jobs still
+move through the usual queues and registries and `/status/{id}` keeps working.
+
+Concurrency is set per queue with `WORKER_CONCURRENCY`, e.g. "high=2,default=8,low=2".
+
+Usage:
+    python -m worker.threaded
+"""
+
+import logging
+import signal
+import threading
+
+from redis import Redis
+from rq import Queue, SimpleWorker
+from rq.timeouts import TimerDeathPenalty
+from rq.utils import utcnow
+
+import worker.operations  # noqa: F401
+from lib.settings import settings
+
+LOG_LEVEL = settings.LOG_LEVEL.upper()
+
+numeric_level = getattr(logging, LOG_LEVEL, None)
+if not isinstance(numeric_level, int):
+    raise ValueError(f"Invalid log level: {LOG_LEVEL}")
+
+logger = logging.getLogger(__name__)
+logger.setLevel(numeric_level)
+handler = logging.StreamHandler()
+formatter = logging.Formatter(
+    "%(asctime)s - %(name)s - %(levelname)s - [%(lineno)d] - %(message)s"
+)
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+# Short worker TTL so idle threads leave their blocking dequeue every few
+# seconds and notice a stop request; busy threads are kept alive by heartbeats.
+WORKER_TTL = 20
+
+
+class ThreadedWorker(SimpleWorker):
+    """
+    rq worker that can run outside of the main thread.
+    """
+
+    # SIGALRM based timeouts only work in the main thread
+    death_penalty_class = TimerDeathPenalty
+
+    def _install_signal_handlers(self):
+        # Signals are handled once for all workers by `main`
+        pass
+
+    def execute_job(self, job, queue):
+        # There is no work-horse monitor in this mode, so keep the job and the
+        # worker from being reaped as abandoned while the job is running.
+        done = threading.Event()
+
+        def heartbeat():
+            while not done.wait(self.job_monitoring_interval):
+                job.heartbeat(utcnow(), self.job_monitoring_interval + 60)
+                self.heartbeat()
+
+        heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+        heartbeat_thread.start()
+        try:
+            super().execute_job(job, queue)
+        finally:
+            done.set()
+
+
+def parse_concurrency(spec):
+    """
+    Parse a "queue=limit,..." string into an ordered {queue: limit} dict.
+    """
+    concurrency = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        queue_name, _, limit = item.partition("=")
+        concurrency[queue_name.strip()] = int(limit) if limit else 1
+    return concurrency
+
+
+def main():
+    redis = Redis(settings.REDIS_HOST, settings.REDIS_PORT)
+    concurrency = parse_concurrency(settings.WORKER_CONCURRENCY)
+
+    workers = []
+    for queue_name, limit in concurrency.items():
+        queue = Queue(queue_name, connection=redis)
+        for _ in range(limit):
+            workers.append(
+                ThreadedWorker(
+                    [queue], connection=redis, default_worker_ttl=WORKER_TTL
+                )
+            )
+
+    def request_stop(signum, frame):
+        logger.info(f"Received signal {signum}, finishing in-flight jobs")
+        for w in workers:
+            w._stop_requested = True
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    threads = [
+        threading.Thread(
+            target=w.work, kwargs={"logging_level": LOG_LEVEL}, name=w.name
+        )
+        for w in workers
+    ]
+    for t in threads:
+        t.start()
+
+    logger.info(f"Started {len(threads)} threaded workers: {concurrency}")
+
+    # Join with a timeout so the main thread stays responsive to signals
+    while any(t.is_alive() for t in threads):
+        for t in threads:
+            t.join(timeout=1)
+
+
+if __name__ == "__main__":
+    main()
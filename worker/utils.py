@@ -1,14 +1,23 @@
+import csv
 import io
+import itertools as it
 import json
 import os
 import sys
 import logging
+import tempfile
+import time
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
 
 import pandas
-import requests
+import pyarrow
+import pyarrow.csv
+import pyarrow.ipc
+import pyarrow.parquet
 
-from lib.auth import auth_session
+from lib.auth import auth_session, http_session
 from lib.settings import settings
+from worker.cache import content_hash
 
 LOG_LEVEL = settings.LOG_LEVEL.upper()
 
@@ -28,11 +37,85 @@ logger.addHandler(handler)
 
 TDS_API = settings.TDS_URL
 
+# Top-level fields of an AMR, as opposed to the ones TDS keeps on a model
+AMR_FIELDS = ("header", "model", "semantics", "metadata")
 
-def put_amr_to_tds(amr_payload, name=None, description=None, model_id=None):
-    # Expects json amr payload and puts it to TDS models and model-configurations, returning an ID.
 
+class SpooledFile(tempfile.SpooledTemporaryFile):
+    """
+    Spooled temporary file usable with `io.TextIOWrapper` and `zipfile`.
+
+    Python 3.10's `SpooledTemporaryFile` lacks the io methods they need (added
+    in 3.11), so they are forwarded to the underlying file here.
+    """
+
+    def readable(self):
+        return self._file.readable()
+
+    def writable(self):
+        return self._file.writable()
+
+    def seekable(self):
+        return self._file.seekable()
+
+    def read1(self, *args):
+        return self._file.read1(*args)
+
+    def readinto(self, b):
+        return self._file.readinto(b)
+
+    def readinto1(self, b):
+        return self._file.readinto1(b)
+
+
+def run_concurrently(func, items, max_workers):
+    """
+    Call `func` on every item using at most `max_workers` threads.
+
+    Results are returned in the order of `items`. The first exception raised by
+    any call is re-raised as soon as it happens and calls that have not started
+    yet are cancelled.
+    """
+    items = list(items)
+    if not items:
+        return []
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(items)))) as executor:
+        futures = [executor.submit(func, item) for item in items]
+        done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+        for future in done:
+            if future.exception() is not None:
+                for pending in not_done:
+                    pending.cancel()
+                raise future.exception()
+
+    return [future.result() for future in futures]
 
+
+def amr_hash(amr_payload):
+    """
+    Hash of the canonical form of an AMR: its AMR fields only, so fields TDS
+    adds to a model (id, timestamp, ...) don't change it, with keys sorted and
+    the stored hash left out.
+    """
+    metadata = amr_payload.get("metadata") or {}
+    canonical = {field: amr_payload.get(field) for field in AMR_FIELDS}
+    canonical["metadata"] = {
+        key: value for key, value in metadata.items() if key != "amr_hash"
+    }
+    return content_hash(canonical)
+
+
+def put_amr_to_tds(amr_payload, name=None, description=None, model_id=None):
+    """
+    Put an AMR to TDS models and create its default model configuration.
+
+    The AMR hash is stored in the model metadata. Updating an existing model
+    with an AMR of the same hash skips both the model PUT and the configuration,
+    in which case `configuration_id` is None and `unchanged` is True. The model
+    must still match its stored hash, as other clients may have changed it
+    without updating the hash.
+    """
     if name:
         amr_payload["header"]["name"] = name
     if description:
@@ -55,6 +138,15 @@ def put_amr_to_tds(amr_payload, name=None, description=None, model_id=None):
                 "description", None
             )
 
+            payload_hash = amr_hash(amr_payload)
+            amr_payload["metadata"] = dict(
+                amr_payload.get("metadata") or {}, amr_hash=payload_hash
+            )
+            stored_hash = (fetched_amr.get("metadata") or {}).get("amr_hash")
+            if stored_hash == payload_hash == amr_hash(fetched_amr):
+                logger.info(f"Model {model_id} in TDS is unchanged, skipping update")
+                return {"model_id": model_id, "configuration_id": None, "unchanged": True}
+
             update_model_response = auth_session().put(
                 tds_models, json=amr_payload
             )
@@ -67,6 +159,9 @@ def put_amr_to_tds(amr_payload, name=None, description=None, model_id=None):
         else:
             # the model couldn't be found, so must be new
             # go ahead and create the model
+            amr_payload["metadata"] = dict(
+                amr_payload.get("metadata") or {}, amr_hash=amr_hash(amr_payload)
+            )
             tds_models = f"{TDS_API}/models"
             model_response = auth_session().post(tds_models, json=amr_payload)
             model_id = model_response.json().get("id")
@@ -74,6 +169,9 @@ def put_amr_to_tds(amr_payload, name=None, description=None, model_id=None):
 
     # No model id was specified, create TDS model with a default UUID id
     else:
+        amr_payload["metadata"] = dict(
+            amr_payload.get("metadata") or {}, amr_hash=amr_hash(amr_payload)
+        )
         tds_models = f"{TDS_API}/models"
         model_response = auth_session().post(tds_models, json=amr_payload)
         model_id = model_response.json().get("id")
@@ -88,7 +186,8 @@ def put_amr_to_tds(amr_payload, name=None, description=None, model_id=None):
         "description": header.get("description", amr_payload.get("description")),
         "model_version": header.get("model_version", amr_payload.get("model_version")),
         "calibrated": False,
-        "configuration": json.loads(json.dumps(amr_payload)),
+        # Serialised below, so the AMR itself can be embedded without a copy
+        "configuration": amr_payload,
     }
 
     config_response = auth_session().post(
@@ -99,7 +198,7 @@ def put_amr_to_tds(amr_payload, name=None, description=None, model_id=None):
     config_id = config_response.json().get("id")
 
     logger.info(f"Created model config in TDS with id {config_id}")
-    return {"model_id": model_id, "configuration_id": config_id}
+    return {"model_id": model_id, "configuration_id": config_id, "unchanged": False}
 
 
 def put_document_extraction_to_tds(
@@ -125,7 +224,9 @@ def put_document_extraction_to_tds(
     else:
         metadata = {}
 
-    if zip_file_name:
+    if isinstance(zip_file_name, list):
+        file_names = [filename, *zip_file_name]
+    elif zip_file_name:
         file_names = [filename, zip_file_name]
     else:
         file_names = [filename]
@@ -192,7 +293,10 @@ def put_code_extraction_to_tds(
     return {"status": code_put_status}
 
 
-def get_document_from_tds(document_id, code=False):
+def get_document_metadata_from_tds(document_id):
+    """
+    Fetch the document record from TDS without downloading its file.
+    """
     tds_documents_url = f"{TDS_API}/document-asset/{document_id}"
     document = auth_session().get(tds_documents_url)
 
@@ -201,14 +305,13 @@ def get_document_from_tds(document_id, code=False):
             f"Cannot download document {document_id} from TDS: {document.text}"
         )
 
-    document_json = document.json()
-    if code:
-        filename = document_json.get("filename")
-    else:
-        filename = document_json.get("file_names")[
-            0
-        ]  # Assumes only one file will be present for now.
+    return document.json()
 
+
+def get_document_content_from_tds(document_id, filename):
+    """
+    Download a file attached to a TDS document through its presigned URL.
+    """
     download_url = f"{TDS_API}/document-asset/{document_id}/download-url?document_id={document_id}&filename={filename}"
     document_download_url = auth_session().get(download_url)
 
@@ -216,7 +319,7 @@ def get_document_from_tds(document_id, code=False):
 
     logger.info(presigned_download)
 
-    downloaded_document = requests.get(document_download_url.json().get("url"))
+    downloaded_document = http_session().get(presigned_download)
 
     logger.info(f"DOCUMENT RETRIEVAL STATUS:{downloaded_document.status_code}")
 
@@ -225,10 +328,154 @@ def get_document_from_tds(document_id, code=False):
             f"Cannot download document {document_id} from TDS: {downloaded_document.text}"
         )
 
-    return document_json, downloaded_document.content
+    return downloaded_document.content
+
+
+def copy_document_file(
+    source_document_id, target_document_id, filename, target_filename=None
+):
+    """
+    Copy a file attached to one TDS document to another through presigned URLs.
+    """
+    target_filename = target_filename or filename
+
+    download_url = f"{TDS_API}/document-asset/{source_document_id}/download-url?document_id={source_document_id}&filename={filename}"
+    presigned_download = auth_session().get(download_url).json().get("url")
+    downloaded_file = http_session().get(presigned_download)
+    if downloaded_file.status_code != 200:
+        raise Exception(
+            f"Cannot download {filename} of document {source_document_id} from TDS: {downloaded_file.text}"
+        )
+
+    upload_url = f"{TDS_API}/document-asset/{target_document_id}/upload-url?filename={target_filename}"
+    presigned_upload = auth_session().get(upload_url).json().get("url")
+    uploaded_file = http_session().put(presigned_upload, io.BytesIO(downloaded_file.content))
+    if uploaded_file.status_code >= 300:
+        raise Exception(
+            f"Failed to upload file to TDS (status: {uploaded_file.status_code}): {target_filename}"
+        )
+
+    return target_filename
+
+
+def line_offsets(content):
+    """
+    Byte offsets at which each line of `content` starts.
+    """
+    offsets = [0]
+    position = content.find(b"\n")
+    while position != -1:
+        offsets.append(position + 1)
+        position = content.find(b"\n", position + 1)
+    return offsets
+
+
+def slice_lines(content, offsets, start_line, end_line):
+    """
+    Lines `start_line` to `end_line` (1-based, inclusive) of `content`, joined
+    with newlines, using its `line_offsets`.
+    """
+    begin = offsets[start_line - 1] if start_line - 1 < len(offsets) else len(content)
+    end = offsets[end_line] if end_line < len(offsets) else len(content)
+    return b"\n".join(content[begin:end].splitlines())
+
+
+def fetch_code_lines(presigned_download, max_line):
+    """
+    Download only the start of a file, up to the end of line `max_line`.
+
+    The file is read in `CODE_RANGE_BYTES` HTTP Range requests; when the store
+    ignores the Range header the full response is streamed until enough lines
+    have arrived instead. Returns None if more than `CODE_MAX_FILE_BYTES` are
+    needed, and raises `requests.HTTPError` on any other error status.
+    """
+    content = bytearray()
+    lines = 0
+    while lines < max_line:
+        start = len(content)
+        headers = {"Range": f"bytes={start}-{start + settings.CODE_RANGE_BYTES - 1}"}
+        with http_session().get(presigned_download, headers=headers, stream=True) as response:
+            logger.debug(f"code RETRIEVAL STATUS:{response.status_code}")
+            if response.status_code == 416:
+                # Range starts past the end of the file
+                break
+            # Error bodies (e.g. an S3 AccessDenied) are not file content
+            response.raise_for_status()
+            ranged = response.status_code == 206
+            if not ranged:
+                content = bytearray()
+                lines = 0
+
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                content.extend(chunk)
+                lines += chunk.count(b"\n")
+                if lines >= max_line:
+                    break
+                if len(content) > settings.CODE_MAX_FILE_BYTES:
+                    return None
+
+        received = len(content) - start
+        if not ranged or received < settings.CODE_RANGE_BYTES:
+            break
+
+    return bytes(content)
+
+
+def download_code_file(code_id, name, max_line=None):
+    """
+    Download one file of a code asset, or return None if it is larger than
+    `CODE_MAX_FILE_BYTES`. With `max_line`, only the lines up to it are fetched.
+    Raises `requests.HTTPError` if the download fails.
+    """
+    # name = name.split("/")[-1]
+    download_url = f"{TDS_API}/code-asset/{code_id}/download-url?filename={name}"
+    code_download_url = auth_session().get(download_url)
+
+    presigned_download = code_download_url.json().get("url")
+
+    logger.info(presigned_download)
+
+    if max_line is not None:
+        content = fetch_code_lines(presigned_download, max_line)
+    else:
+        with http_session().get(presigned_download, stream=True) as downloaded_code:
+            logger.info(f"code RETRIEVAL STATUS:{downloaded_code.status_code}")
+            # Error bodies are not source code
+            downloaded_code.raise_for_status()
+
+            content = bytearray()
+            for chunk in downloaded_code.iter_content(chunk_size=1024 * 1024):
+                content.extend(chunk)
+                if len(content) > settings.CODE_MAX_FILE_BYTES:
+                    content = None
+                    break
+
+    if content is None:
+        logger.warning(
+            f"Skipping {name} of code asset {code_id}, it is larger than {settings.CODE_MAX_FILE_BYTES} bytes"
+        )
+        return None
+
+    return bytes(content)
+
+
+def parse_line_range(block):
+    """
+    Parse a dynamics block such as "L12-L40" into (12, 40).
+    """
+    start_line, end_line = block.split("-")
+
+    # Convert the extracted strings to integers, removing leading 'L'
+    return int(start_line[1:]), int(end_line[1:])
 
 
-def get_code_from_tds(code_id, code=False, dynamics_only=False):
+def get_code_from_tds(code_id, code=False, dynamics_only=False, file_filter=None):
+    """
+    Fetch a code asset and download its files concurrently.
+
+    When whole files are downloaded, `file_filter` (if given) is called with the
+    files of the asset and returns the ones worth downloading.
+    """
     dynamics_off = False
     tds_codes_url = f"{TDS_API}/code-asset/{code_id}"
     logger.info(tds_codes_url)
@@ -257,81 +504,247 @@ def get_code_from_tds(code_id, code=False, dynamics_only=False):
     else:
         file_names = files
 
-    content_object = {}
-
-    for name, blocks in file_names.items():
-        # name = name.split("/")[-1]
-        download_url = f"{TDS_API}/code-asset/{code_id}/download-url?filename={name}"
-        code_download_url = auth_session().get(download_url)
-
-        presigned_download = code_download_url.json().get("url")
-
-        logger.info(presigned_download)
+    if not dynamics_only and file_filter is not None:
+        file_names = file_filter(file_names)
+
+    started = time.perf_counter()
+    # Dynamics only need the start of each file, up to its last block
+    downloads = run_concurrently(
+        lambda item: download_code_file(
+            code_id,
+            item[0],
+            max(parse_line_range(block)[1] for block in item[1])
+            if dynamics_only
+            else None,
+        ),
+        file_names.items(),
+        max_workers=settings.CODE_DOWNLOAD_CONCURRENCY,
+    )
+    download_stats = {
+        "files": sum(content is not None for content in downloads),
+        "skipped": sum(content is None for content in downloads),
+        "bytes": sum(len(content) for content in downloads if content is not None),
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+    logger.info(f"Downloaded code asset {code_id}: {download_stats}")
 
-        downloaded_code = requests.get(code_download_url.json().get("url"))
+    content_object = {}
 
-        logger.info(f"code RETRIEVAL STATUS:{downloaded_code.status_code}")
+    for (name, blocks), content in zip(file_names.items(), downloads):
+        if content is None:
+            continue
 
         if dynamics_only:
+            # Index the lines once and slice every block from it
+            offsets = line_offsets(content)
             all_dynamic_blocks = []
             for block in blocks:
-                start_line, end_line = block.split("-")
-
-                # Convert the extracted strings to integers, removing leading 'L'
-                start_line = int(start_line[1:])
-                end_line = int(end_line[1:])
-
-                # Get the lines from the code
-                code_lines = downloaded_code.content.splitlines()
-                target_lines = code_lines[start_line - 1 : end_line]
-                logger.info(target_lines)
-
-                # Join the lines into a single string
-                target_block = b"\n".join(target_lines)
+                start_line, end_line = parse_line_range(block)
+                target_block = slice_lines(content, offsets, start_line, end_line)
+                logger.info(target_block)
 
                 # Add the block to the list of blocks
                 all_dynamic_blocks.append(target_block.decode("utf-8"))
 
             content_object[name] = all_dynamic_blocks
         else:
-            content_object[name] = downloaded_code.content
+            content_object[name] = content
 
-    return code_json, content_object, dynamics_off
+    return code_json, content_object, dynamics_off, download_stats
 
 
-def get_dataset_from_tds(dataset_id):
-    tds_datasets_url = f"{TDS_API}/datasets/{dataset_id}"
+COLUMNAR_FORMATS = {
+    ".parquet": "parquet",
+    ".pq": "parquet",
+    ".arrow": "arrow",
+    ".feather": "arrow",
+    ".ipc": "arrow",
+}
 
-    dataset = auth_session().get(tds_datasets_url)
-    dataset_json = dataset.json()
 
-    logger.info(f"DATASET RESPONSE JSON: {dataset_json}")
+def dataset_file_format(filename):
+    return COLUMNAR_FORMATS.get(os.path.splitext(filename)[1].lower(), "csv")
 
-    dataframes = []
-    for filename in dataset_json.get("file_names", []):
-        gen_download_url = f"{TDS_API}/datasets/{dataset_id}/download-url?dataset_id={dataset_id}&filename={filename}"
-        dataset_download_url = auth_session().get(gen_download_url)
 
-        logger.info(f"{dataset_download_url} {dataset_download_url.json().get('url')}")
+def download_dataset_file(dataset_id, filename):
+    """
+    Stream one dataset file from TDS into a temporary file.
+
+    CSV files are spooled; Parquet and Arrow files go to a named temporary file
+    so they can be memory-mapped. Returns the file format and the file.
+    """
+    file_format = dataset_file_format(filename)
+
+    gen_download_url = f"{TDS_API}/datasets/{dataset_id}/download-url?dataset_id={dataset_id}&filename={filename}"
+    dataset_download_url = auth_session().get(gen_download_url)
 
-        downloaded_dataset = requests.get(dataset_download_url.json().get("url"))
+    logger.info(f"{dataset_download_url} {dataset_download_url.json().get('url')}")
 
+    if file_format == "csv":
+        dataset_file = SpooledFile(
+            max_size=settings.DATASET_SPOOL_MAX_SIZE
+        )
+    else:
+        dataset_file = tempfile.NamedTemporaryFile(suffix=os.path.splitext(filename)[1])
+    with http_session().get(
+        dataset_download_url.json().get("url"), stream=True
+    ) as downloaded_dataset:
         logger.info(downloaded_dataset)
+        if downloaded_dataset.status_code != 200:
+            dataset_file.close()
+            raise Exception(
+                f"Cannot download {filename} of dataset {dataset_id} from TDS: {downloaded_dataset.text}"
+            )
+        for chunk in downloaded_dataset.iter_content(chunk_size=1024 * 1024):
+            dataset_file.write(chunk)
 
-        dataset_file = io.BytesIO(downloaded_dataset.content)
-        dataset_file.seek(0)
+    dataset_file.flush()
+    dataset_file.seek(0)
+    return file_format, dataset_file
 
-        dataframe = pandas.read_csv(dataset_file)
-        dataframes.append(dataframe)
 
-    if len(dataframes) > 1:
-        final_df = pandas.concat(dataframes, ignore_index=True)
+def iter_columnar_batches(file_format, dataset_file):
+    """
+    Read a Parquet or Arrow IPC file memory-mapped, yielding record batches.
+    """
+    with pyarrow.memory_map(dataset_file.name) as source:
+        if file_format == "parquet":
+            yield from pyarrow.parquet.ParquetFile(source).iter_batches(
+                batch_size=settings.DATA_PROFILE_CHUNK_ROWS
+            )
+        else:
+            try:
+                reader = pyarrow.ipc.open_file(source)
+                batches = (
+                    reader.get_batch(i) for i in range(reader.num_record_batches)
+                )
+            except pyarrow.ArrowInvalid:
+                source.seek(0)
+                batches = pyarrow.ipc.open_stream(source)
+            yield from batches
+
+
+def iter_dataset_frames(file_format, dataset_file):
+    """
+    Read a dataset file of any supported format as DataFrame chunks.
+    """
+    if file_format == "csv":
+        dataset_file.seek(0)
+        yield from pandas.read_csv(
+            dataset_file, chunksize=settings.DATA_PROFILE_CHUNK_ROWS
+        )
     else:
-        final_df = dataframes[0]
+        for batch in iter_columnar_batches(file_format, dataset_file):
+            yield batch.to_pandas()
+
+
+def columnar_to_csv(file_format, dataset_file):
+    """
+    Convert a Parquet or Arrow file to CSV batch by batch with Arrow's writer.
+    """
+    csv_file = SpooledFile(max_size=settings.DATASET_SPOOL_MAX_SIZE)
+    writer = None
+    for batch in iter_columnar_batches(file_format, dataset_file):
+        if writer is None:
+            writer = pyarrow.csv.CSVWriter(csv_file, batch.schema)
+        writer.write_batch(batch)
+    if writer is not None:
+        writer.close()
+    csv_file.seek(0)
+    return csv_file
+
+
+def concat_csv_files(csv_files, output):
+    """
+    Streaming equivalent of `pandas.concat(...).to_csv()`: rows of every file
+    are written to `output` under the union of their headers, with columns a
+    file lacks left empty. Files sharing the combined header are copied as is.
+
+    Returns the combined header.
+    """
+    readers = []
+    for csv_file in csv_files:
+        # utf-8-sig drops the byte order mark of e.g. Excel exports
+        text = io.TextIOWrapper(csv_file, encoding="utf-8-sig", newline="")
+        reader = csv.reader(text)
+        readers.append((text, reader, next(reader, [])))
+
+    columns = list(dict.fromkeys(it.chain.from_iterable(h for _, _, h in readers)))
+
+    out = io.TextIOWrapper(output, encoding="utf-8", newline="")
+    writer = csv.writer(out, lineterminator="\n")
+    writer.writerow(columns)
+    for text, reader, header in readers:
+        if header == columns:
+            # csv.reader reads line by line, so the rest of the file is the body
+            last = "\n"
+            while chunk := text.read(1024 * 1024):
+                out.write(chunk)
+                last = chunk[-1]
+            if last not in "\r\n":
+                out.write("\n")
+        else:
+            positions = [columns.index(column) for column in header]
+            for row in reader:
+                combined = [""] * len(columns)
+                for position, value in zip(positions, row):
+                    combined[position] = value
+                writer.writerow(combined)
+
+    out.flush()
+    out.detach()
+    # Detach so the wrappers don't close the files when collected
+    for text, _, _ in readers:
+        text.detach()
+    output.seek(0)
+    return columns
+
+
+def download_dataset_from_tds(dataset_id):
+    """
+    Fetch a dataset and download its files concurrently.
 
-    csv_string = final_df.to_csv(index=False)
+    Returns the TDS response and a list of (format, file) pairs, which the
+    caller should close.
+    """
+    tds_datasets_url = f"{TDS_API}/datasets/{dataset_id}"
 
-    return dataset, final_df, csv_string
+    dataset = auth_session().get(tds_datasets_url)
+    dataset_json = dataset.json()
+
+    logger.info(f"DATASET RESPONSE JSON: {dataset_json}")
+
+    dataset_files = run_concurrently(
+        lambda filename: download_dataset_file(dataset_id, filename),
+        dataset_json.get("file_names", []),
+        max_workers=settings.DATASET_DOWNLOAD_CONCURRENCY,
+    )
+    return dataset, dataset_files
+
+
+def combine_dataset_files(dataset_files):
+    """
+    Combine dataset files of any supported format into one spooled CSV file.
+    """
+    csv_files = []
+    try:
+        for file_format, dataset_file in dataset_files:
+            if file_format == "csv":
+                dataset_file.seek(0)
+                csv_files.append(dataset_file)
+            else:
+                csv_files.append(columnar_to_csv(file_format, dataset_file))
+
+        csv_file = SpooledFile(
+            max_size=settings.DATASET_SPOOL_MAX_SIZE
+        )
+        concat_csv_files(csv_files, csv_file)
+    finally:
+        # Converted files are ours, the originals belong to the caller
+        for csv_file_part, (_, dataset_file) in zip(csv_files, dataset_files):
+            if csv_file_part is not dataset_file:
+                csv_file_part.close()
+    return csv_file
 
 
 def get_model_from_tds(model_id):